@@ -0,0 +1,291 @@
+import argparse
+import boto3
+import functools
+import os
+import threading
+import time
+import requests
+
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from threading import Thread
+from urllib3.util.retry import Retry
+
+# arcane botocore s3 stuff needed for zero-auth reads
+from botocore import UNSIGNED
+from botocore.config import Config
+
+# statuses worth retrying - throttling and transient server-side failures
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def worker_lookahead(idx, n, batch_size, length, num_workers=None):
+    '''
+    Returns the next n dataset indices (starting with idx) that the current
+    DataLoader worker will ask for.
+
+    The pipeline's DataLoader hands out whole batches to its workers round-robin,
+    so once a worker reaches the end of its batch it skips over the batches
+    given to the other workers. Prefetching along this path means no worker
+    downloads an image that another worker is going to ask for.
+    '''
+    if num_workers is None:
+        from torch.utils.data import get_worker_info
+        info = get_worker_info()
+        num_workers = 1 if info is None else info.num_workers
+    stride = max(num_workers, 1) * batch_size
+    indices = []
+    batch_start = idx - idx % batch_size
+    i = idx
+    while len(indices) < n and i < length:
+        indices.append(i)
+        i += 1
+        if i == batch_start + batch_size:
+            batch_start += stride
+            i = batch_start
+    return indices
+
+class Fetcher:
+    '''
+    Base class for downloaders that keep a bounded number of requests in flight
+    on a thread pool, ahead of whatever is consuming them.
+
+    The thread pool (and any client a subclass holds) is created lazily, so a
+    fetcher can be built in the main process and pickled into DataLoader
+    workers - every worker then gets its own pool and its own connections.
+    They're created under a lock, since the pool's threads all ask for the
+    client at once, and dropped in a forked child, which can't use the
+    parent's threads (or a lock one of them held at the fork).
+    '''
+    # attributes that only make sense in the process that created them
+    PROCESS_LOCAL = ('_executor',)
+
+    def __init__(self, max_workers: int = 8, prefetch: int = 16):
+        self.max_workers = max_workers
+        self.prefetch = prefetch
+        self._reset()
+
+    def _reset(self):
+        for name in self.PROCESS_LOCAL:
+            setattr(self, name, None)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in [*self.PROCESS_LOCAL, '_pending', '_lock', '_pid']:
+            state.pop(name)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def _process_local(self, name, factory):
+        '''
+        returns the attribute name, creating it with factory() if this process
+        doesn't have one yet
+        '''
+        if self._pid != os.getpid():
+            self._reset()
+        value = getattr(self, name)
+        if value is None:
+            with self._lock:
+                value = getattr(self, name)
+                if value is None:
+                    value = factory()
+                    setattr(self, name, value)
+        return value
+
+    @property
+    def executor(self):
+        return self._process_local('_executor', lambda: ThreadPoolExecutor(self.max_workers))
+
+    @property
+    def in_flight(self):
+        '''
+        number of submitted downloads that haven't finished yet
+        '''
+        return sum(not future.done() for future in self._pending.values())
+
+    def fetch(self, key) -> bytes:
+        '''
+        downloads a single object and returns its contents
+        '''
+        raise NotImplementedError
+
+    def get(self, keys, indices):
+        '''
+        Returns the contents of keys[indices[0]]. The remaining indices are the
+        ones expected to be asked for next, and are submitted to the pool so
+        they download while the caller decodes and runs the model.
+        '''
+        upcoming = set(indices)
+        for stale in [i for i in self._pending if i not in upcoming]:
+            self._pending.pop(stale).cancel()
+        for i in indices:
+            if i not in self._pending:
+                self._pending[i] = self.executor.submit(self.fetch, keys[i])
+        return self._pending.pop(indices[0]).result()
+
+class HTTPFetcher(Fetcher):
+    '''
+    Fetches URLs through a single keep-alive session, with a connection pool
+    sized to the number of concurrent requests, a timeout, and retries with
+    exponential backoff on connection errors and retryable statuses.
+    '''
+    PROCESS_LOCAL = Fetcher.PROCESS_LOCAL + ('_session',)
+
+    def __init__(self,
+                 max_workers: int = 8,
+                 prefetch: int = 16,
+                 timeout: float = 60,
+                 retries: int = 3,
+                 backoff_factor: float = 0.5):
+        super().__init__(max_workers=max_workers, prefetch=prefetch)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+
+    def make_session(self):
+        retry = Retry(total=self.retries,
+                      backoff_factor=self.backoff_factor,
+                      status_forcelist=RETRY_STATUSES,
+                      allowed_methods=['GET', 'HEAD'])
+        adapter = HTTPAdapter(pool_connections=self.max_workers,
+                              pool_maxsize=self.max_workers,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @property
+    def session(self):
+        return self._process_local('_session', self.make_session)
+
+    def fetch(self, url):
+        response = self.session.get(url, timeout=self.timeout)
+        if response.status_code == 200:
+            return response.content
+        else:
+            raise Exception(f"Failed to download image at: {url}, HTTP {response.status_code}")
+
+class S3Fetcher(Fetcher):
+    '''
+    Fetches s3://bucket/key URLs. Each process builds its own client (and so its
+    own connection pool) the first time it downloads something. Objects bigger
+    than multipart_threshold are pulled with parallel ranged GETs of
+    multipart_chunksize bytes, max_concurrency at a time.
+    '''
+    PROCESS_LOCAL = Fetcher.PROCESS_LOCAL + ('_client',)
+
+    def __init__(self,
+                 max_workers: int = 8,
+                 prefetch: int = 16,
+                 max_concurrency: int = 4,
+                 multipart_threshold: int = 8*1024*1024,
+                 multipart_chunksize: int = 4*1024*1024,
+                 endpoint_url: str = None,
+                 unsigned: bool = True):
+        super().__init__(max_workers=max_workers, prefetch=prefetch)
+        self.max_concurrency = max_concurrency
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self.endpoint_url = endpoint_url
+        self.unsigned = unsigned
+
+    def make_client(self):
+        config = Config(max_pool_connections=self.max_workers*self.max_concurrency,
+                        retries={'max_attempts': 5, 'mode': 'adaptive'})
+        if self.unsigned:
+            config = config.merge(Config(signature_version=UNSIGNED))
+        return boto3.session.Session().client('s3',
+                                              endpoint_url=self.endpoint_url,
+                                              config=config)
+
+    @property
+    def client(self):
+        # boto3 clients aren't safe to create from several threads at once
+        return self._process_local('_client', self.make_client)
+
+    @property
+    def transfer_config(self):
+        return TransferConfig(multipart_threshold=self.multipart_threshold,
+                              multipart_chunksize=self.multipart_chunksize,
+                              max_concurrency=self.max_concurrency)
+
+    def fetch(self, url):
+        # url is formatted as s3://bucket/key
+        bucket_name, key = split_s3_url(url)
+        # trick to read the image directly into memory rather than going
+        # to disk twice for no reason
+        f = BytesIO()
+        self.client.download_fileobj(bucket_name, key, f, Config=self.transfer_config)
+        return f.getvalue()
+
+def split_s3_url(url):
+    '''
+    splits s3://bucket/key into (bucket, key)
+    '''
+    url_parts = url.removeprefix("s3://").split('/')
+    return url_parts[0], '/'.join(url_parts[1:])
+
+class LatencyHTTPRequestHandler(SimpleHTTPRequestHandler):
+    '''
+    Serves files from a directory, sleeping for `latency` seconds before each
+    response to stand in for a remote bucket
+    '''
+    latency = 0.
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_directory(root, latency=0., port=0):
+    '''
+    Starts a local HTTP server for the files under root on a background thread.
+    Returns the server and its base URL; call server.shutdown() when done.
+    '''
+    handler = type('Handler', (LatencyHTTPRequestHandler,), {'latency': latency})
+    server = ThreadingHTTPServer(('127.0.0.1', port),
+                                 functools.partial(handler, directory=str(root)))
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+if __name__ == "__main__":
+    # compares one-at-a-time requests.get against HTTPFetcher on a local
+    # server with injected latency, eg: python fetch_utils.py ./images --latency 0.05
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root', help='directory of images to serve')
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--max-workers', type=int, default=8)
+    args = parser.parse_args()
+
+    root = Path(args.root)
+    server, base_url = serve_directory(root, latency=args.latency)
+    urls = [f'{base_url}/{p.relative_to(root).as_posix()}' for p in sorted(root.rglob('*')) if p.is_file()]
+
+    start = time.perf_counter()
+    serial_bytes = sum(len(requests.get(url).content) for url in urls)
+    serial_time = time.perf_counter() - start
+
+    fetcher = HTTPFetcher(max_workers=args.max_workers, prefetch=args.max_workers*2)
+    start = time.perf_counter()
+    pooled_bytes = 0
+    for i in range(len(urls)):
+        pooled_bytes += len(fetcher.get(urls, list(range(i, min(i + fetcher.prefetch, len(urls))))))
+    pooled_time = time.perf_counter() - start
+    server.shutdown()
+
+    assert serial_bytes == pooled_bytes
+    print(f'{len(urls)} files, {serial_bytes/1e6:.1f} MB')
+    print(f'serial requests.get: {len(urls)/serial_time:.1f} files/sec')
+    print(f'HTTPFetcher:         {len(urls)/pooled_time:.1f} files/sec')
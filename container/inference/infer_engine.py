@@ -0,0 +1,438 @@
+import argparse
+import multiprocessing
+import os
+import pickle
+import sys
+import tempfile
+import time
+import pandas as pd
+import torch
+
+from contextlib import nullcontext
+from pathlib import Path
+from transformers import AutoImageProcessor, pipeline
+from tqdm import tqdm
+
+from ladi_pipeline import LADIImageClassificationPipeline
+from decode_utils import model_input_size
+from result_writer import ResultWriter, score_rows
+from result_cache import ResultCache
+from sources import SOURCES, IMAGE_EXTENSIONS, KeyStream
+from scan_utils import SCAN_THREADS
+from stage_stats import StageStats
+from metrics import InferenceMetrics
+from tiling import TILE_COLUMNS, TiledDataset, aggregate_tiles
+from spatial_index import SpatialIndex, index_path
+
+MODEL_NAME = 'MITLL/LADI-v2-classifier-small'
+
+labels = ['trees_any',
+          'water_any',
+          'trees_damage',
+          'debris_any',
+          'roads_any',
+          'flooding_any',
+          'buildings_any',
+          'buildings_affected_or_greater',
+          'bridges_any',
+          'flooding_structures',
+          'roads_damage']
+
+def build_pipeline(model_name: str, device=None, num_workers: int = 4):
+    '''
+    loads the classifier as a LADIImageClassificationPipeline
+    '''
+    return pipeline(model=model_name,
+                    task='image-classification',
+                    pipeline_class=LADIImageClassificationPipeline,
+                    function_to_apply='sigmoid',
+                    device=device,
+                    num_workers=num_workers)
+
+def parse_device(device):
+    '''
+    turns --device into what pipeline() expects: an int for a GPU index,
+    otherwise a string like 'cpu' or 'cuda:1', or None for the default
+    '''
+    if device is None or not device.lstrip('-').isdigit():
+        return device
+    return int(device)
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Runs the LADI classifier over a set of images and writes the scores, '
+                                                 'along with the position and time from their EXIF data, to a CSV or Parquet file.')
+    parser.add_argument('source', choices=SOURCES.keys(),
+                        help='files: text files listing local images, dir: directories to search for images, '
+                             'urls: HTTP URLs or text files listing them, s3: s3://bucket/prefix URLs')
+    parser.add_argument('inputs', nargs='+', help='what to run on, see source')
+    parser.add_argument('--model', default=MODEL_NAME, help='model name on the Hub, or a local checkpoint')
+    parser.add_argument('--output', default='outputs.csv', help='results file, written as Parquet if it ends in .parquet')
+    parser.add_argument('--batch-size', type=int, default=12)
+    parser.add_argument('--num-workers', type=int, default=4, help='DataLoader worker processes for loading images')
+    parser.add_argument('--shm-ring', action='store_true',
+                        help='hand preprocessed batches from the workers to the model through a fixed ring of shared '
+                             'memory buffers instead of a new shared memory segment per batch, which takes load off '
+                             'the main process with many workers')
+    parser.add_argument('--device', default=None, help='eg: cpu, cuda, cuda:1 or a GPU index')
+    parser.add_argument('--onnx', default=None,
+                        help='run a model exported by export_onnx.py (eg: onnx_model/model.int8.onnx) with ONNX Runtime '
+                             'on the CPU instead of --model with PyTorch')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='CPU threads for the model (per shard with --shards), defaults to one per core')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='split the inputs between this many CPU model processes, each with an equal share of the '
+                             'cores and of --num-workers. Rows are still written in input order')
+    parser.add_argument('--spatial-index', action='store_true',
+                        help='when the run is done, index the results by position next to --output, for '
+                             'spatial_index.py query')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='rows to buffer before writing them out')
+    parser.add_argument('--cache', default=None,
+                        help='sqlite file of results from earlier runs - images whose fingerprint (S3 ETag, or size and mtime) '
+                             'is unchanged are not re-scored')
+    parser.add_argument('--stats-json', default=None,
+                        help='write throughput, latency percentiles, per-stage timings and peak memory for the run to this file')
+    parser.add_argument('--metrics-file', default=None,
+                        help='periodically write fetch, decode, preprocess and model timings, queue depths and error '
+                             'counts to this file in the Prometheus text format, eg: for node_exporter\'s textfile collector')
+    parser.add_argument('--metrics-interval', type=float, default=15., help='seconds between --metrics-file updates')
+    parser.add_argument('--reduced-decode', action='store_true',
+                        help='decode JPEGs at the smallest DCT scale that is still at least the model input size')
+    parser.add_argument('--tile-size', type=int, default=None,
+                        help='score each image as overlapping tiles of this many pixels square at full resolution, '
+                             'instead of shrinking the whole image to the model input size. Rows come out in the order '
+                             'images finish rather than input order')
+    parser.add_argument('--tile-overlap', type=int, default=None,
+                        help='pixels neighbouring tiles overlap by, defaults to a quarter of --tile-size')
+    parser.add_argument('--tile-aggregate', choices=['max', 'mean'], default='max',
+                        help='how tile scores are combined into the image\'s score for each label')
+    parser.add_argument('--tile-output', default=None,
+                        help='also write the scores of every tile, with its position in the image, to this file')
+    parser.add_argument('--extensions', nargs='+', default=IMAGE_EXTENSIONS, type=str.lower,
+                        help='only score files with these extensions (dir, s3)')
+    parser.add_argument('--min-size', type=int, default=0, help='skip images smaller than this many bytes (files, dir, s3)')
+    parser.add_argument('--max-size', type=int, default=None, help='skip images larger than this many bytes (files, dir, s3)')
+    parser.add_argument('--scan-threads', type=int, default=SCAN_THREADS,
+                        help='directory listings and file stats to have in flight at once when finding and checking '
+                             'local images (files, dir)')
+    parser.add_argument('--dedup', choices=['content', 'perceptual'], default=None,
+                        help='score each set of identical images once and copy the scores to the rest. content: same '
+                             'bytes (files), or same size and ETag (s3). perceptual: also near-identical images by '
+                             'difference hash, eg: re-encoded copies (files)')
+    parser.add_argument('--phash-distance', type=int, default=0,
+                        help='with --dedup perceptual, how many of the 64 hash bits two images can differ by')
+    parser.add_argument('--stream-listing', action=argparse.BooleanOptionalAction, default=False,
+                        help='start scoring as soon as the first page of keys is listed instead of after the whole '
+                             'listing. Rows come out in the order they finish rather than listing order (s3)')
+    parser.add_argument('--fetch-concurrency', type=int, default=8, help='concurrent downloads per worker (urls, s3)')
+    parser.add_argument('--prefetch', type=int, default=16, help='images each worker downloads ahead (urls, s3)')
+    parser.add_argument('--s3-endpoint', default=None, help='S3 endpoint URL, eg: a local stand-in (s3)')
+    parser.add_argument('--s3-signed', action='store_true', help='sign S3 requests with your AWS credentials (s3)')
+    parser.add_argument('--s3-https-paths', action='store_true',
+                        help='write s3://bucket/key paths as https://bucket.s3.amazonaws.com/key (s3)')
+    return parser
+
+def load_pipeline(args):
+    if args.onnx is not None:
+        # only imported here so onnxruntime isn't needed for the PyTorch backend
+        from onnx_backend import build_onnx_pipeline
+        return build_onnx_pipeline(args.onnx, args.num_workers, args.threads)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    return build_pipeline(args.model, parse_device(args.device), args.num_workers)
+
+def load_image_processor(args):
+    # exported models keep their image processor next to the .onnx file
+    return AutoImageProcessor.from_pretrained(args.model if args.onnx is None else Path(args.onnx).parent)
+
+def cached_row(source, key, row):
+    '''
+    a row from the result cache, with the file_path this run writes for key.
+    The cache keeps the key itself, so options like --s3-https-paths only
+    apply to the run they're given to
+    '''
+    return {**row, 'file_path': source.display_path(key)}
+
+def write_cached(stream, source, writer, progress):
+    '''
+    writes out the rows KeyStream has found in the cache so far
+    '''
+    while not stream.cached.empty():
+        writer.write(cached_row(source, *stream.cached.get()))
+        progress.update(1)
+    progress.total = stream.listed
+    progress.refresh()
+
+def drop_failed(scores, metadata, stats):
+    '''
+    splits the images that couldn't be loaded (see sources.failed_item) out of
+    a batch. Returns the rest of the batch, and the failed images' metadata
+    '''
+    failed = [x for x in metadata if 'error' in x]
+    if len(failed) == 0:
+        return scores, metadata, stats, failed
+    keep = [i for i, x in enumerate(metadata) if 'error' not in x]
+    return scores[keep], [metadata[i] for i in keep], [stats[i] for i in keep], failed
+
+def score(args, pipe, source, ds, writer, cache=None, fingerprints=None, metrics=None, position=None, stream=None,
+          duplicates=None, tile_writer=None):
+    '''
+    runs ds through the model, writing a row for each image to writer and
+    adding it to cache (if given). Returns the run's StageStats.
+
+    duplicates maps keys to {duplicate key: its metadata} for other keys with
+    the same contents (see --dedup), which get the key's scores along with
+    their own metadata instead of going through the model.
+
+    For a streamed listing, ds is the source's stream_dataset and stream the
+    KeyStream feeding it, which is started here once the DataLoader workers
+    are, and whose cached rows are written out between batches.
+
+    With --tile-size the model sees tiles rather than images, and the batches
+    below are the images whose tiles have all been scored. tile_writer gets
+    the scores of each tile, if given.
+
+    Images that can't be downloaded or decoded are reported and left out,
+    along with their duplicates, rather than ending the run.
+    '''
+    stage_stats = StageStats()
+    progress = tqdm(total=len(ds) if stream is None else None, position=position)
+    if args.tile_size is not None:
+        ds = TiledDataset(ds, args.tile_size, args.tile_overlap, block_size=args.batch_size)
+    # scores come back as one (batch, labels) array per batch, columns in the order of labels
+    batches = pipe.iter_score_batches(ds, labels, batch_size=args.batch_size, shm_ring=args.shm_ring,
+                                      on_start=None if stream is None else stream.start)
+    if args.tile_size is not None:
+        def write_tiles(scores, metadata):
+            # like their images, tiles of images that couldn't be loaded are left out
+            keep = [i for i, x in enumerate(metadata) if 'error' not in x]
+            tile_writer.write_scores([{'file_path': source.display_path(metadata[i]['file_path']),
+                                       **{k: metadata[i][k] for k in TILE_COLUMNS}} for i in keep],
+                                     scores[keep], labels)
+        batches = aggregate_tiles(batches, args.tile_aggregate, write_tiles if tile_writer is not None else None)
+    try:
+        for scores, metadata, stats in batches:
+            if stream is not None:
+                write_cached(stream, source, writer, progress)
+            scores, metadata, stats, failed = drop_failed(scores, metadata, stats)
+            for img_metadata in failed:
+                tqdm.write(f"skipping {source.display_path(img_metadata['file_path'])}, "
+                           f"{img_metadata['error_type']}: {img_metadata['error']}")
+            stage_stats.failed += len(failed)
+            if metrics is not None:
+                for img_metadata in failed:
+                    metrics.error(img_metadata['error_type'])
+            progress.update(len(failed))
+            if len(metadata) == 0:
+                continue
+            start = time.perf_counter()
+            batch_keys = [x['file_path'] for x in metadata]
+            for img_metadata in metadata:
+                img_metadata['file_path'] = source.display_path(img_metadata['file_path'])
+            duplicate_rows = []
+            if cache is not None or duplicates:
+                for key, row in zip(batch_keys, score_rows(metadata, scores, labels)):
+                    if cache is not None:
+                        cache.put(key, fingerprints[key], {**row, 'file_path': key})
+                    for duplicate, duplicate_metadata in (duplicates or {}).get(key, {}).items():
+                        # only the scores are shared - the position and time are the duplicate's own
+                        duplicate_rows.append((duplicate, {'file_path': source.display_path(duplicate),
+                                                           **{label: row[label] for label in sorted(labels)},
+                                                           **duplicate_metadata}))
+                        if cache is not None:
+                            cache.put(duplicate, fingerprints[duplicate], {**duplicate_rows[-1][1], 'file_path': duplicate})
+            postprocessed = time.perf_counter()
+            writer.write_scores(metadata, scores, labels)
+            for _, row in duplicate_rows:
+                writer.write(row)
+            write_time = time.perf_counter() - postprocessed
+            stage_stats.add_batch(stats, postprocess=postprocessed - start, write=write_time)
+            if metrics is not None:
+                metrics.observe_batch(metadata, stats, write_time, writer.buffered)
+            progress.update(len(metadata) + len(duplicate_rows))
+        if stream is not None:
+            stream.thread.join()
+            if stream.error is not None:
+                raise stream.error
+            write_cached(stream, source, writer, progress)
+    except Exception as e:
+        if metrics is not None:
+            metrics.error(type(e).__name__)
+        raise
+    finally:
+        # the last numbers are written out however the run ends
+        if metrics is not None:
+            metrics.write()
+    progress.close()
+    return stage_stats
+
+def run_shard(args, source, keys, draft_size, cache_model_name, fingerprints, duplicates, shard, part_path):
+    '''
+    scores one slice of keys in its own process for --shards, with its share of
+    the CPU threads and DataLoader workers. Rows go to part_path, and the
+    StageStats are pickled next to it.
+    '''
+    if args.threads is None:
+        args.threads = max(1, os.cpu_count()//args.shards)
+    args.num_workers = args.num_workers//args.shards if args.num_workers >= args.shards else min(args.num_workers, 1)
+    pipe = load_pipeline(args)
+    cache = None if args.cache is None else ResultCache(args.cache, cache_model_name)
+    with ResultWriter(part_path, chunk_size=args.chunk_size, score_columns=labels) as writer:
+        ds = source.dataset(keys, args.batch_size, draft_size)
+        stage_stats = score(args, pipe, source, ds, writer, cache, fingerprints, position=shard, duplicates=duplicates)
+    if cache is not None:
+        cache.close()
+    with open(f'{part_path}.stats', 'wb') as f:
+        pickle.dump(stage_stats, f)
+
+def run_shards(args, source, keys, draft_size, cache_model_name, fingerprints, duplicates, writer):
+    '''
+    splits keys into args.shards contiguous slices, scores each in its own
+    process, then copies their rows into writer in input order
+    '''
+    stage_stats = StageStats()
+    shard_size = max(1, -(-len(keys)//args.shards))
+    slices = [keys[i:i+shard_size] for i in range(0, len(keys), shard_size)]
+    # the parent hasn't loaded the model or run anything with torch yet, so the
+    # shards can be forked from it (as their DataLoader workers are from them)
+    context = multiprocessing.get_context('fork')
+    with tempfile.TemporaryDirectory(dir=Path(args.output).resolve().parent) as part_dir:
+        part_paths = [str(Path(part_dir)/f'shard-{i:05}.csv') for i in range(len(slices))]
+        processes = []
+        for i, (shard_keys, part_path) in enumerate(zip(slices, part_paths)):
+            shard_duplicates = {key: duplicates[key] for key in shard_keys if key in duplicates}
+            shard_fingerprints = None
+            if fingerprints:
+                shard_fingerprints = {key: fingerprints[key] for key in shard_keys}
+                shard_fingerprints.update((x, fingerprints[x]) for xs in shard_duplicates.values() for x in xs)
+            process = context.Process(target=run_shard,
+                                      args=(args, source, shard_keys, draft_size, cache_model_name,
+                                            shard_fingerprints, shard_duplicates, i, part_path))
+            process.start()
+            processes.append(process)
+        for process in processes:
+            process.join()
+        failed = [i for i, process in enumerate(processes) if process.exitcode != 0]
+        if len(failed) > 0:
+            raise RuntimeError(f"shards {failed} failed, see their errors above")
+        for part_path in part_paths:
+            for chunk in pd.read_csv(part_path, chunksize=args.chunk_size, dtype={'file_path': str}, keep_default_na=False, na_values=['']):
+                writer.write_frame(chunk)
+            with open(f'{part_path}.stats', 'rb') as f:
+                stage_stats.merge(pickle.load(f))
+    return stage_stats
+
+def run(args):
+    source = SOURCES[args.source](args.inputs, args)
+    model_name = args.model if args.onnx is None else args.onnx
+    # with --shards the model is only loaded in the shard processes
+    pipe = load_pipeline(args) if args.shards == 1 else None
+    image_processor = load_image_processor(args) if pipe is None else pipe.image_processor
+    draft_size = model_input_size(image_processor) if args.reduced_decode else None
+    # reduced decoding changes the scores slightly, and tiling changes them a lot,
+    # so those results are cached separately
+    cache_model_name = model_name if draft_size is None else f'{model_name}@draft{draft_size}'
+    if args.tile_size is not None:
+        cache_model_name += f'@tile{args.tile_size}-{args.tile_overlap}-{args.tile_aggregate}'
+    cache = None if args.cache is None else ResultCache(args.cache, cache_model_name)
+    metrics = None if args.metrics_file is None else InferenceMetrics(args.metrics_file, args.metrics_interval)
+
+    # rows are written out every chunk_size images rather than all at the end
+    with ResultWriter(args.output, chunk_size=args.chunk_size, score_columns=labels) as writer, \
+         (nullcontext() if args.tile_output is None else
+          ResultWriter(args.tile_output, chunk_size=args.chunk_size, score_columns=labels)) as tile_writer:
+        if args.stream_listing:
+            # keys go to the workers (or the cache lookup) as each page is listed
+            # started by score, after the DataLoader has forked its workers
+            stream = KeyStream(source.list_pages(), args.num_workers, args.cache, cache_model_name)
+            ds = source.stream_dataset(stream.keys, draft_size)
+            stage_stats = score(args, pipe, source, ds, writer, cache, stream.fingerprints, metrics, stream=stream,
+                                tile_writer=tile_writer)
+            if cache is not None:
+                print(f"{stream.cached_count} of {stream.listed} images were unchanged in {args.cache}")
+        else:
+            keys = source.list()
+            if len(keys) == 0:
+                print("No files exist")
+                sys.exit(1)
+
+            fingerprints = {}
+            if cache is not None:
+                fingerprints = source.fingerprints(keys)
+                cached_rows = cache.lookup(fingerprints.items())
+                for key in keys:
+                    if key in cached_rows:
+                        writer.write(cached_row(source, key, cached_rows[key]))
+                keys = [key for key in keys if key not in cached_rows]
+                print(f"{len(cached_rows)} unchanged images found in {args.cache}, scoring {len(keys)}")
+
+            duplicates = {}
+            if args.dedup is not None:
+                duplicate_of = source.duplicates(keys, perceptual=args.dedup == 'perceptual', max_distance=args.phash_distance)
+                duplicate_metadata = source.metadata(list(duplicate_of))
+                for duplicate, canonical in duplicate_of.items():
+                    duplicates.setdefault(canonical, {})[duplicate] = duplicate_metadata[duplicate]
+                keys = [key for key in keys if key not in duplicate_of]
+                print(f"{len(duplicate_of)} duplicate images found, scoring {len(keys)}")
+
+            if args.shards > 1:
+                if cache is not None:
+                    # the shards open the cache themselves
+                    cache.close()
+                    cache = None
+                stage_stats = run_shards(args, source, keys, draft_size, cache_model_name, fingerprints, duplicates, writer)
+            else:
+                ds = source.dataset(keys, args.batch_size, draft_size)
+                stage_stats = score(args, pipe, source, ds, writer, cache, fingerprints, metrics, duplicates=duplicates,
+                                    tile_writer=tile_writer)
+
+    if cache is not None:
+        cache.close()
+    if args.spatial_index:
+        index = SpatialIndex.build(args.output, labels)
+        index.save(index_path(args.output))
+        print(f"indexed the {len(index)} images with a position in {index_path(args.output)}")
+    if stage_stats.failed > 0:
+        print(f"{stage_stats.failed} images couldn't be loaded and were left out, see above")
+    if stage_stats.tiles > 0:
+        summary = stage_stats.summary()
+        print(f"scored {summary['tiles']} tiles from {summary['images']} images, {summary['tiles_per_sec']:.1f} tiles/sec")
+    if args.stats_json is not None:
+        stage_stats.save(args.stats_json)
+
+def main(argv=None, **defaults):
+    '''
+    command line entry point. defaults override the parser's defaults, which
+    lets the per-source scripts keep their own batch sizes, devices, etc.
+    '''
+    parser = get_parser()
+    parser.set_defaults(**defaults)
+    args = parser.parse_args(argv)
+    if args.shards > 1 and parse_device(args.device) not in [None, 'cpu', -1]:
+        parser.error('--shards runs every shard on the CPU, leave out --device or use --device cpu')
+    if args.tile_size is not None:
+        if args.tile_overlap is None:
+            args.tile_overlap = args.tile_size//4
+        if not 0 <= args.tile_overlap < args.tile_size:
+            parser.error('--tile-overlap has to be at least 0 and less than --tile-size')
+        if args.reduced_decode:
+            parser.error('--reduced-decode throws away the detail --tile-size is for, use one or the other')
+    elif args.tile_output is not None:
+        parser.error('--tile-output needs --tile-size')
+    if args.tile_output is not None and args.shards > 1:
+        parser.error('--tile-output can\'t be used with --shards')
+    if args.dedup is not None and args.dedup not in SOURCES[args.source].DEDUP_MODES:
+        supported = [name for name, source in SOURCES.items() if args.dedup in source.DEDUP_MODES]
+        parser.error(f'--dedup {args.dedup} only works with the {", ".join(supported)} sources, not {args.source}')
+    if args.dedup is not None and args.stream_listing:
+        parser.error('--dedup needs the whole listing up front, it can\'t be used with --stream-listing')
+    if args.stream_listing and not SOURCES[args.source].STREAM_LISTING:
+        streaming = [name for name, source in SOURCES.items() if source.STREAM_LISTING]
+        parser.error(f'--stream-listing only works with the {" or ".join(streaming)} source, not {args.source}')
+    if args.shards > 1 and args.stream_listing:
+        parser.error('--stream-listing can\'t be used with --shards')
+    if args.shards > 1 and args.metrics_file is not None:
+        parser.error('--metrics-file only covers a single process, it can\'t be used with --shards')
+    run(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import time
+import torch
+
+from PIL import Image
+from torch.utils.data import DataLoader, IterableDataset
+from transformers import ImageClassificationPipeline
+from transformers.pipelines.base import pad_collate_fn
+from transformers.pipelines.pt_utils import PipelineDataset, PipelineIterator
+from typing import List
+
+from shm_ring import RingCollate, RingSlot, ShmRing
+
+class LADIImageClassificationPipeline(ImageClassificationPipeline):
+    '''
+    Image classification pipeline that also accepts items of the form
+    {'image': <PIL image>, 'metadata': {...}}. The metadata rides along with the
+    preprocessed image through the DataLoader, model and postprocessing, and
+    each result comes back as {'scores': [...], 'metadata': {...}}.
+
+    This lets a Dataset hand back whatever it learned while loading an image
+    (file path, EXIF position, ...) without a side channel to the main process.
+    Items can also carry a 'stats' dict of stage timings in seconds (see
+    stage_stats.py), which gets the preprocess and model times added to it.
+
+    Build it with pipeline(..., pipeline_class=LADIImageClassificationPipeline)
+    '''
+    def check_model_type(self, supported_models):
+        # the ONNX Runtime backend (onnx_backend.py) stands in for the PyTorch
+        # model, so it isn't one of the classes transformers knows about
+        if isinstance(self.model, torch.nn.Module):
+            super().check_model_type(supported_models)
+
+    def preprocess(self, image, timeout=None):
+        metadata = None
+        stats = {}
+        if isinstance(image, dict):
+            metadata = image.get('metadata')
+            stats = image.get('stats', {})
+            image = image['image']
+        start = time.perf_counter()
+        model_inputs = super().preprocess(image, timeout=timeout)
+        stats['preprocess'] = time.perf_counter() - start
+        model_inputs['metadata'] = metadata
+        model_inputs['stats'] = stats
+        return model_inputs
+
+    def _forward(self, model_inputs):
+        # after batching these are lists with one dict per image
+        metadata = model_inputs.pop('metadata')
+        stats = model_inputs.pop('stats')
+        model_outputs = super()._forward(model_inputs)
+        # logits has to stay the first key, the pipeline reads the batch size off it
+        return {'logits': model_outputs['logits'], 'metadata': metadata, 'stats': stats}
+
+    def postprocess(self, model_outputs, function_to_apply=None, top_k=5):
+        scores = super().postprocess(model_outputs, function_to_apply=function_to_apply, top_k=top_k)
+        return {'scores': scores, 'metadata': model_outputs['metadata'], 'stats': model_outputs['stats']}
+
+    def label_columns(self, labels: List[str]) -> List[int]:
+        '''
+        the logit index for each of labels, in the same order
+        '''
+        return [int(self.model.config.label2id[label]) for label in labels]
+
+    def preprocessed_shape(self):
+        '''
+        the shape and dtype of one preprocessed image, without the batch dimension
+        '''
+        pixel_values = super().preprocess(Image.new('RGB', (64, 64)))['pixel_values']
+        return pixel_values.shape[1:], pixel_values.dtype
+
+    def iter_score_batches(self, dataset, labels: List[str], batch_size: int = 12, num_workers: int = None,
+                           shm_ring: bool = False, on_start=None):
+        '''
+        Fast path that skips postprocess: runs dataset through the model and
+        yields (scores, metadata, stats) once per batch. scores is a float32 NumPy
+        array of sigmoid scores with one row per image and column i holding
+        labels[i]; metadata and stats are the lists of per-image metadata and
+        stage timing dicts, in the same order. Each image is charged an equal
+        share of its batch's model time, and of the time spent waiting for the
+        DataLoader to hand the batch over (loader_wait). They also get
+        loader_prefetched, how many batches the DataLoader's workers had been
+        given but hadn't handed back yet when the batch arrived.
+
+        num_workers defaults to the num_workers the pipeline was built with.
+        dataset can also be an IterableDataset, in which case it's up to the
+        dataset to split the work between workers.
+
+        shm_ring: hand each batch from the DataLoader workers to this process
+        through a ShmRing (see shm_ring.py) rather than a new shared memory
+        segment per batch. Only makes a difference with num_workers > 0.
+
+        on_start: called once the DataLoader's workers have been started, eg:
+            to start threads that mustn't be running when they're forked
+        '''
+        columns = torch.tensor(self.label_columns(labels), device=self.device)
+        if isinstance(dataset, IterableDataset):
+            dataset = PipelineIterator(dataset, self.preprocess, {})
+        else:
+            dataset = PipelineDataset(dataset, self.preprocess, {})
+        num_workers = (self._num_workers or 0) if num_workers is None else num_workers
+        collate_fn = pad_collate_fn(None, self.image_processor)
+        ring = None
+        if shm_ring and num_workers > 0:
+            item_shape, dtype = self.preprocessed_shape()
+            prefetch_factor = 2
+            # a slot for every batch the DataLoader can have in flight, plus the one being scored
+            ring = ShmRing(num_workers*prefetch_factor + 1, batch_size, item_shape, dtype)
+            collate_fn = RingCollate(collate_fn, ring)
+        loader = DataLoader(dataset,
+                            batch_size=batch_size,
+                            num_workers=num_workers,
+                            prefetch_factor=prefetch_factor if ring is not None else None,
+                            collate_fn=collate_fn)
+        waited = time.perf_counter()
+        batches = iter(loader)
+        if on_start is not None:
+            on_start()
+        for batch in batches:
+            # the DataLoader's own count of batches sent to workers and not yet
+            # received - its prefetch queue depth. Always 0 without workers
+            prefetched = getattr(batches, '_tasks_outstanding', 0)
+            metadata = batch.pop('metadata')
+            stats = batch.pop('stats')
+            start = time.perf_counter()
+            # time spent waiting on the DataLoader for this batch - if it's high,
+            # loading images is the bottleneck rather than the model
+            loader_wait = (start - waited)/len(stats)
+            handle = batch['pixel_values']
+            if isinstance(handle, RingSlot):
+                batch['pixel_values'] = ring.view(handle)
+            batch = self._ensure_tensor_on_device(batch, device=self.device)
+            with torch.inference_mode():
+                logits = self.model(**batch).logits
+            # .cpu() waits for the GPU, so this covers the whole forward pass
+            scores = torch.sigmoid(logits[:, columns].float()).cpu().numpy()
+            if isinstance(handle, RingSlot):
+                ring.release(handle)
+            model_time = (time.perf_counter() - start)/len(stats)
+            for img_stats in stats:
+                img_stats['model'] = model_time
+                img_stats['loader_wait'] = loader_wait
+                img_stats['loader_prefetched'] = prefetched
+            yield scores, metadata, stats
+            waited = time.perf_counter()
@@ -0,0 +1,143 @@
+import math
+import os
+import time
+
+from bisect import bisect_left
+from pathlib import Path
+from typing import List
+
+# bucket upper bounds in seconds, covering per-image stages (a few ms to a few
+# seconds for a slow download) and whole model batches
+TIME_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.]
+
+class Histogram:
+    '''
+    a Prometheus-style cumulative histogram: a count per bucket, plus the total
+    count and sum of everything observed
+    '''
+    def __init__(self, name: str, help: str, buckets: List[float] = TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def lines(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        total = 0
+        for bound, count in zip(self.buckets + [math.inf], self.counts):
+            total += count
+            le = '+Inf' if bound == math.inf else repr(bound)
+            lines.append(f'{self.name}_bucket{{le="{le}"}} {total}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+class Metric:
+    '''
+    a counter or gauge, optionally split by one label
+    '''
+    def __init__(self, name: str, help: str, kind: str = 'counter', label: str = None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label = label
+        # unlabelled metrics start at 0 so they show up before anything happens
+        self.values = {} if label is not None else {None: 0}
+
+    def inc(self, amount: float = 1, label_value: str = None):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def set(self, value: float, label_value: str = None):
+        self.values[label_value] = value
+
+    def lines(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for label_value, value in self.values.items():
+            labels = '' if label_value is None else f'{{{self.label}="{label_value}"}}'
+            lines.append(f'{self.name}{labels} {value}')
+        return lines
+
+class InferenceMetrics:
+    '''
+    Counters and histograms for an inference run, built from the per-image
+    stats dicts that come back with each batch (see stage_stats.py), and
+    written to a file in the Prometheus text format every `interval` seconds.
+    Point node_exporter's textfile collector at the file's directory to scrape
+    it while the run is going, eg: --metrics-file /var/lib/node_exporter/ladi.prom
+
+    path: the metrics file, replaced atomically on every write
+    interval: minimum seconds between writes
+    '''
+    def __init__(self, path, interval: float = 15.):
+        self.path = Path(path)
+        self.interval = interval
+        self.last_write = 0.
+        self.images = Metric('ladi_images_total', 'Images scored')
+        self.fetch_bytes = Metric('ladi_fetch_bytes_total', 'Bytes downloaded')
+        self.no_position = Metric('ladi_images_without_position_total', 'Scored images with no EXIF GPS position')
+        self.errors = Metric('ladi_errors_total', 'Images that could not be downloaded or decoded, and errors that '
+                                                  'stopped the run, by exception type', label='type')
+        self.fetch_in_flight = Metric('ladi_fetch_in_flight', 'Downloads in flight per DataLoader worker, mean over the last batch', kind='gauge')
+        self.loader_prefetched = Metric('ladi_loader_prefetched_batches', 'Batches given to DataLoader workers but not yet handed to the model, as of the last batch', kind='gauge')
+        self.buffered_rows = Metric('ladi_writer_buffered_rows', 'Rows waiting to be written out', kind='gauge')
+        self.last_batch = Metric('ladi_last_batch_timestamp_seconds', 'When the last batch was written', kind='gauge')
+        self.fetch_seconds = Histogram('ladi_fetch_seconds', 'Time spent waiting for each image to download')
+        self.decode_seconds = Histogram('ladi_decode_seconds', 'Time spent decoding each image')
+        self.preprocess_seconds = Histogram('ladi_preprocess_seconds', 'Time spent in the image processor for each image')
+        self.model_batch_seconds = Histogram('ladi_model_batch_seconds', 'Time spent running the model on each batch')
+        self.loader_wait_seconds = Histogram('ladi_loader_wait_seconds', 'Time spent waiting for the DataLoader to produce each batch')
+        self.write_batch_seconds = Histogram('ladi_write_batch_seconds', 'Time spent writing each batch out')
+
+    def observe_batch(self, metadata: List[dict], stats: List[dict], write_seconds: float = 0., buffered_rows: int = 0):
+        self.images.inc(len(stats))
+        for img_metadata, img_stats in zip(metadata, stats):
+            if 'fetch' in img_stats:
+                self.fetch_seconds.observe(img_stats['fetch'])
+                self.fetch_bytes.inc(img_stats['fetch_bytes'])
+            if 'decode' in img_stats:
+                self.decode_seconds.observe(img_stats['decode'])
+            if 'preprocess' in img_stats:
+                self.preprocess_seconds.observe(img_stats['preprocess'])
+            lat = img_metadata.get('lat')
+            if lat is None or lat != lat:
+                self.no_position.inc()
+        self.model_batch_seconds.observe(sum(x.get('model', 0.) for x in stats))
+        self.loader_wait_seconds.observe(sum(x.get('loader_wait', 0.) for x in stats))
+        self.write_batch_seconds.observe(write_seconds)
+        in_flight = [x['fetch_in_flight'] for x in stats if 'fetch_in_flight' in x]
+        if len(in_flight) > 0:
+            self.fetch_in_flight.set(sum(in_flight)/len(in_flight))
+        if len(stats) > 0 and 'loader_prefetched' in stats[0]:
+            self.loader_prefetched.set(stats[0]['loader_prefetched'])
+        self.buffered_rows.set(buffered_rows)
+        self.last_batch.set(time.time())
+        if time.monotonic() - self.last_write >= self.interval:
+            self.write()
+
+    def error(self, error_type: str):
+        '''
+        counts an error of the exception type named error_type: an image that
+        was left out (see sources.failed_item), or the error that ended the run
+        '''
+        self.errors.inc(label_value=error_type)
+
+    def write(self):
+        lines = []
+        for metric in [self.images, self.fetch_bytes, self.no_position, self.errors, self.fetch_in_flight,
+                       self.loader_prefetched, self.buffered_rows, self.last_batch, self.fetch_seconds, self.decode_seconds,
+                       self.preprocess_seconds, self.model_batch_seconds, self.loader_wait_seconds,
+                       self.write_batch_seconds]:
+            lines += metric.lines()
+        # the collector reads whatever is in the file, so it's swapped in whole
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.path)
+        self.last_write = time.monotonic()
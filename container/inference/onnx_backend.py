@@ -0,0 +1,59 @@
+import torch
+
+from pathlib import Path
+from transformers import AutoConfig, AutoImageProcessor
+from transformers.modeling_outputs import ImageClassifierOutput
+
+from ladi_pipeline import LADIImageClassificationPipeline
+
+class ONNXImageClassifier:
+    '''
+    Runs an exported classifier (see export_onnx.py) with ONNX Runtime on the
+    CPU. It stands in for the PyTorch model inside the pipeline: it has the
+    model's config, takes pixel_values and returns an output with .logits, so
+    preprocessing, batching and postprocessing are unchanged.
+
+    onnx_path: the .onnx file, eg: model.onnx or the quantized model.int8.onnx
+    config: the model config saved next to it, for the labels
+    num_threads: intra-op threads for ONNX Runtime, defaults to one per core
+    '''
+    def __init__(self, onnx_path, config, num_threads: int = None):
+        # onnxruntime is only needed when this backend is used
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(str(onnx_path), options, providers=['CPUExecutionProvider'])
+        self.config = config
+        self.device = torch.device('cpu')
+        self.dtype = torch.float32
+
+    def to(self, device):
+        if torch.device(device).type != 'cpu':
+            raise ValueError(f"The ONNX backend only runs on the CPU, not {device}")
+        return self
+
+    def eval(self):
+        return self
+
+    def can_generate(self):
+        return False
+
+    def __call__(self, pixel_values, **kwargs):
+        logits = self.session.run(['logits'], {'pixel_values': pixel_values.cpu().numpy()})[0]
+        return ImageClassifierOutput(logits=torch.from_numpy(logits))
+
+def build_onnx_pipeline(onnx_path, num_workers: int = 4, num_threads: int = None):
+    '''
+    loads an exported classifier as a LADIImageClassificationPipeline. The
+    config and image processor are read from the directory the .onnx file is in.
+    '''
+    model_dir = Path(onnx_path).parent
+    config = AutoConfig.from_pretrained(model_dir)
+    return LADIImageClassificationPipeline(model=ONNXImageClassifier(onnx_path, config, num_threads),
+                                           image_processor=AutoImageProcessor.from_pretrained(model_dir),
+                                           task='image-classification',
+                                           function_to_apply='sigmoid',
+                                           device=-1,
+                                           num_workers=num_workers)
@@ -0,0 +1,85 @@
+import json
+import os
+import sqlite3
+
+from typing import Dict, Iterable, Tuple
+
+def file_fingerprint(path):
+    '''
+    size+mtime fingerprint for a local file, or None if it can't be stat'd
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f'{st.st_size}-{st.st_mtime_ns}'
+
+class ResultCache:
+    '''
+    Persistent store of result rows keyed by (key, model name), tagged with a
+    fingerprint of the input (an S3 ETag, or size+mtime for local files).
+
+    On a re-run, any key whose fingerprint hasn't changed can take its row from
+    here instead of going through the model again, so only new or modified
+    images are scored. Rows are stored with the key itself as their file_path,
+    whatever the run that scored them wrote (eg: https:// paths for s3://
+    keys), so each run can write its own.
+
+    path: the sqlite database to use, created if it doesn't exist
+    model_name: results from different models are kept apart
+    commit_every: how many new rows to buffer before committing them
+    '''
+    def __init__(self, path: str, model_name: str, commit_every: int = 1000):
+        self.path = path
+        self.model_name = model_name
+        self.commit_every = commit_every
+        self.pending = []
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results ('
+                          'key TEXT NOT NULL, model TEXT NOT NULL, fingerprint TEXT NOT NULL, row TEXT NOT NULL, '
+                          'PRIMARY KEY (key, model))')
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def lookup(self, items: Iterable[Tuple[str, str]], chunk_size: int = 500) -> Dict[str, dict]:
+        '''
+        takes (key, fingerprint) pairs and returns {key: row} for the ones that
+        have a cached row with a matching fingerprint
+        '''
+        items = [(k, f) for k, f in items if f is not None]
+        hits = {}
+        for start in range(0, len(items), chunk_size):
+            chunk = dict(items[start:start+chunk_size])
+            placeholders = ','.join('?'*len(chunk))
+            cursor = self.conn.execute(f'SELECT key, fingerprint, row FROM results '
+                                       f'WHERE model = ? AND key IN ({placeholders})',
+                                       [self.model_name, *chunk.keys()])
+            for key, fingerprint, row in cursor:
+                if chunk[key] == fingerprint:
+                    hits[key] = json.loads(row)
+        return hits
+
+    def put(self, key: str, fingerprint: str, row: dict):
+        if fingerprint is None:
+            return
+        self.pending.append((key, self.model_name, fingerprint, json.dumps(row)))
+        if len(self.pending) >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        if len(self.pending) == 0:
+            return
+        self.conn.executemany('INSERT OR REPLACE INTO results (key, model, fingerprint, row) VALUES (?, ?, ?, ?)',
+                              self.pending)
+        self.conn.commit()
+        self.pending = []
+
+    def close(self):
+        self.commit()
+        self.conn.close()
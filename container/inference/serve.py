@@ -0,0 +1,249 @@
+import argparse
+import json
+import queue
+import threading
+import time
+import torch
+
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from PIL import Image
+
+from decode_utils import model_input_size, open_image
+from fetch_utils import HTTPFetcher, S3Fetcher
+from infer_engine import MODEL_NAME, build_pipeline, labels, parse_device
+from metadata_utils import get_metadata_bytes
+
+class InvalidImageError(ValueError):
+    '''
+    an image in a request that couldn't be decoded or preprocessed - the
+    client's fault, unlike anything that goes wrong after it's queued
+    '''
+
+class MicroBatcher:
+    '''
+    Runs the model on a background thread, coalescing images submitted from any
+    number of request threads into batches. A batch is started as soon as
+    max_batch_size images are waiting, or max_wait_ms after the first of them
+    arrived, whichever comes first - so a lone request waits at most
+    max_wait_ms, while a burst of requests shares model calls.
+
+    pipe: a LADIImageClassificationPipeline (PyTorch or ONNX backend)
+    labels: the labels to score, in the order scores are returned
+    '''
+    def __init__(self, pipe, labels, max_batch_size: int = 16, max_wait_ms: float = 10.):
+        self.pipe = pipe
+        self.labels = labels
+        self.columns = torch.tensor(pipe.label_columns(labels), device=pipe.device)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms/1000
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.images = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, pixel_values) -> Future:
+        '''
+        queues one preprocessed image (pixel_values of shape (1, C, H, W)) and
+        returns a Future for its list of scores
+        '''
+        future = Future()
+        self.queue.put((pixel_values, future))
+        return future
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            futures = [future for _, future in batch]
+            try:
+                pixel_values = torch.cat([x for x, _ in batch]).to(self.pipe.device)
+                with torch.inference_mode():
+                    logits = self.pipe.model(pixel_values=pixel_values).logits
+                scores = torch.sigmoid(logits[:, self.columns].float()).cpu().tolist()
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.images += len(batch)
+            for future, img_scores in zip(futures, scores):
+                future.set_result(img_scores)
+
+class ScoringService:
+    '''
+    what the request handler needs: decodes and preprocesses images on the
+    request threads, then hands them to the MicroBatcher
+    '''
+    def __init__(self, pipe, batcher, draft_size=None, fetch_concurrency=8, timeout=60.):
+        self.pipe = pipe
+        self.batcher = batcher
+        self.draft_size = draft_size
+        self.timeout = timeout
+        self.http_fetcher = HTTPFetcher(max_workers=fetch_concurrency)
+        self.s3_fetcher = S3Fetcher(max_workers=fetch_concurrency)
+
+    def fetch(self, url):
+        if url.startswith('s3://'):
+            return self.s3_fetcher.fetch(url)
+        return self.http_fetcher.fetch(url)
+
+    def fetch_all(self, urls):
+        return list(self.http_fetcher.executor.map(self.fetch, urls))
+
+    def score(self, images, names):
+        '''
+        scores each of images (as bytes) and returns one result dict per image:
+        its name, the score for each label, and the position and time from its EXIF
+        '''
+        pixel_values = []
+        for name, data in zip(names, images):
+            try:
+                img = open_image(BytesIO(data), self.draft_size).convert('RGB')
+                pixel_values.append(self.pipe.image_processor(images=img, return_tensors='pt')['pixel_values'])
+            except (OSError, ValueError, Image.DecompressionBombError) as e:
+                # unreadable, truncated or absurdly large images
+                raise InvalidImageError(f'could not decode {name or "the image"}: {e}') from e
+        # nothing is queued until every image has decoded, so a bad one doesn't waste model time
+        futures = [self.batcher.submit(x) for x in pixel_values]
+        results = []
+        for name, data, future in zip(names, images, futures):
+            scores = future.result(timeout=self.timeout)
+            results.append({'file_path': name,
+                            'scores': dict(zip(self.batcher.labels, scores)),
+                            **get_metadata_bytes(data)})
+        return results
+
+def parse_score_request(body):
+    '''
+    reads the URLs out of a JSON /score request. Returns (urls, single), where
+    single is whether the request was for one URL rather than a list. Raises
+    ValueError if the body isn't {"url": "..."} or {"urls": ["...", ...]}
+    '''
+    try:
+        request = json.loads(body)
+    except ValueError as e:
+        raise ValueError(f'invalid JSON: {e}') from e
+    if isinstance(request, dict) and isinstance(request.get('url'), str):
+        return [request['url']], True
+    if isinstance(request, dict) and isinstance(request.get('urls'), list) and \
+            all(isinstance(x, str) for x in request['urls']):
+        return request['urls'], False
+    raise ValueError('expected a JSON body of the form {"url": "..."} or {"urls": ["...", ...]}')
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    '''
+    GET /health: the model and how many batches and images have been scored
+    POST /score: either the bytes of an image (any Content-Type but JSON), which
+        returns one result, or JSON {"url": ...} for one result or
+        {"urls": [...]} for a list of them. URLs can be http(s):// or s3://
+    '''
+    service = None
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_json(404, {'error': f'no such endpoint: {self.path}'})
+            return
+        batcher = self.service.batcher
+        self.send_json(200, {'status': 'ok',
+                             'model': self.server.model_name,
+                             'labels': batcher.labels,
+                             'batches': batcher.batches,
+                             'images': batcher.images})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self.send_json(404, {'error': f'no such endpoint: {self.path}'})
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            try:
+                urls, single = parse_score_request(body)
+            except ValueError as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            try:
+                images = self.service.fetch_all(urls)
+            except Exception as e:
+                self.send_json(502, {'error': f'could not download every image: {e}'})
+                return
+            names = urls
+        else:
+            single = True
+            images = [body]
+            names = [None]
+        try:
+            results = self.service.score(images, names)
+        except InvalidImageError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        except (FutureTimeoutError, TimeoutError):
+            self.send_json(503, {'error': f'timed out after {self.service.timeout}s waiting for the model, try again later'})
+            return
+        except Exception as e:
+            self.send_json(500, {'error': f'scoring failed: {type(e).__name__}: {e}'})
+            return
+        self.send_json(200, results[0] if single else results)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+if __name__ == "__main__":
+    # keeps the classifier loaded and scores images sent over HTTP, eg:
+    # python serve.py --port 8080 --max-batch-size 16 --max-wait-ms 10
+    # curl --data-binary @image.jpg -H 'Content-Type: image/jpeg' localhost:8080/score
+    # curl -d '{"urls": ["https://..."]}' -H 'Content-Type: application/json' localhost:8080/score
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--model', default=MODEL_NAME, help='model name on the Hub, or a local checkpoint')
+    parser.add_argument('--onnx', default=None, help='serve a model exported by export_onnx.py with ONNX Runtime instead')
+    parser.add_argument('--device', default=None, help='eg: cpu, cuda, cuda:1 or a GPU index')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads for the model')
+    parser.add_argument('--max-batch-size', type=int, default=16, help='most images to run through the model at once')
+    parser.add_argument('--max-wait-ms', type=float, default=10.,
+                        help='longest an image waits for others to batch with before the model is run')
+    parser.add_argument('--reduced-decode', action='store_true',
+                        help='decode JPEGs at the smallest DCT scale that is still at least the model input size')
+    parser.add_argument('--fetch-concurrency', type=int, default=8, help='concurrent downloads for URL requests')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    if args.onnx is not None:
+        from onnx_backend import build_onnx_pipeline
+        pipe = build_onnx_pipeline(args.onnx, num_workers=0, num_threads=args.threads)
+    else:
+        if args.threads is not None:
+            torch.set_num_threads(args.threads)
+        pipe = build_pipeline(args.model, parse_device(args.device), num_workers=0)
+    draft_size = model_input_size(pipe.image_processor) if args.reduced_decode else None
+
+    batcher = MicroBatcher(pipe, labels, args.max_batch_size, args.max_wait_ms)
+    handler = type('Handler', (ScoringHandler,), {'service': ScoringService(pipe, batcher, draft_size, args.fetch_concurrency)})
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    server.model_name = args.onnx or args.model
+    server.verbose = args.verbose
+    print(f'serving {server.model_name} on http://{args.host}:{server.server_address[1]}')
+    server.serve_forever()
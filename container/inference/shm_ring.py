@@ -0,0 +1,81 @@
+import multiprocessing
+import torch
+
+from torch.utils.data import get_worker_info
+from typing import NamedTuple
+
+class RingSlot(NamedTuple):
+    '''
+    what crosses from a DataLoader worker to the main process in place of a
+    batch's pixel_values: which slot of the ring they're in, and how many images
+    '''
+    slot: int
+    size: int
+
+class ShmRing:
+    '''
+    A fixed set of batch-sized buffers in shared memory, for handing batches of
+    preprocessed images from DataLoader workers to the model process without
+    copying them through a pipe.
+
+    Without it, each worker stacks its batch into a new tensor, and PyTorch
+    moves that into a freshly created shared memory segment, passes its file
+    descriptor over, and maps it in the main process - a segment set up and
+    torn down per batch, which keeps the main process busy with 40 workers and
+    large batches. Here the buffers are allocated once, before the workers
+    start: a worker takes a free slot, writes its images straight into it, and
+    sends back a RingSlot. The main process views the slot as a tensor (no
+    copy), runs the model on it, and releases it for reuse.
+
+    slots: how many batches can be in flight at once. The DataLoader keeps
+        num_workers * prefetch_factor batches in flight plus the one the model
+        is on, so it needs at least that many, or workers wait on each other
+    batch_size, item_shape, dtype: the shape of each slot, eg: (12, 3, 224, 224)
+    '''
+    def __init__(self, slots: int, batch_size: int, item_shape, dtype=torch.float32, context=None):
+        self.tensors = torch.empty((slots, batch_size, *item_shape), dtype=dtype).share_memory_()
+        self.free = (context or multiprocessing).Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+
+    def fits(self, items) -> bool:
+        return len(items) <= self.tensors.shape[1] and all(x.shape[1:] == self.tensors.shape[2:] for x in items)
+
+    def put(self, items) -> RingSlot:
+        '''
+        copies a batch of (1, C, H, W) tensors into a free slot, waiting for one
+        if they're all in use
+        '''
+        slot = self.free.get()
+        for i, x in enumerate(items):
+            self.tensors[slot, i].copy_(x[0])
+        return RingSlot(slot, len(items))
+
+    def view(self, handle: RingSlot) -> torch.Tensor:
+        return self.tensors[handle.slot, :handle.size]
+
+    def release(self, handle: RingSlot):
+        '''
+        returns a slot to the ring once nothing is using its contents any more
+        '''
+        self.free.put(handle.slot)
+
+class RingCollate:
+    '''
+    collate_fn for the DataLoader that puts each batch's pixel_values in the
+    ring and everything else through collate_fn as usual. Batches collated in
+    the main process (num_workers=0), or whose images don't fit a slot, are
+    left as they are.
+    '''
+    def __init__(self, collate_fn, ring: ShmRing):
+        self.collate_fn = collate_fn
+        self.ring = ring
+
+    def __call__(self, items):
+        pixel_values = [x['pixel_values'] for x in items]
+        if get_worker_info() is None or not self.ring.fits(pixel_values):
+            return self.collate_fn(items)
+        handle = self.ring.put(pixel_values)
+        batch = self.collate_fn([{k: v for k, v in x.items() if k != 'pixel_values'} for x in items])
+        batch['pixel_values'] = handle
+        return batch
@@ -0,0 +1,116 @@
+import json
+import time
+import numpy as np
+
+from array import array
+from typing import List
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is left out there
+    resource = None
+
+# the stages an image goes through, in order. Datasets time fetch and decode,
+# LADIImageClassificationPipeline times preprocess and model, and the engine
+# times postprocess (per-batch bookkeeping) and write
+STAGES = ['fetch', 'decode', 'preprocess', 'model', 'postprocess', 'write']
+
+def peak_rss_mb():
+    '''
+    peak resident memory of this process, and the largest of its finished
+    child processes (eg: DataLoader workers), in MB
+    '''
+    if resource is None:
+        return None, None
+    # ru_maxrss is in KB on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024)
+
+class StageStats:
+    '''
+    Adds up the per-image stage timings that ride through the pipeline in each
+    item's 'stats' dict, along with each image's latency from the moment its
+    Dataset started loading it (stats['start'], a time.time() timestamp) to
+    the moment its row was written.
+
+    Only the totals and one float per image are kept, so it's cheap enough to
+    leave on for every run.
+    '''
+    def __init__(self):
+        self.totals = {stage: 0. for stage in STAGES}
+        self.counts = {stage: 0 for stage in STAGES}
+        self.latencies = array('d')
+        self.images = 0
+        # images that couldn't be downloaded or decoded, and were left out
+        self.failed = 0
+        self.tiles = 0
+        self.fetch_bytes = 0
+        self.start = time.perf_counter()
+
+    def add_batch(self, stats: List[dict], done: float = None, **batch_times):
+        '''
+        stats: the per-image stats dicts for a batch
+        done: time.time() when the batch was finished, defaults to now
+        batch_times: seconds spent on the whole batch for other stages, eg:
+            write=0.01, which are shared equally between its images
+        '''
+        done = time.time() if done is None else done
+        for stage, seconds in batch_times.items():
+            for img_stats in stats:
+                img_stats[stage] = seconds/len(stats)
+        for img_stats in stats:
+            for stage in STAGES:
+                if stage in img_stats:
+                    self.totals[stage] += img_stats[stage]
+                    self.counts[stage] += 1
+            if 'start' in img_stats:
+                self.latencies.append(done - img_stats['start'])
+            self.fetch_bytes += img_stats.get('fetch_bytes', 0)
+            # images scored as tiles (see tiling.py) say how many they were cut into
+            self.tiles += img_stats.get('tiles', 0)
+        self.images += len(stats)
+
+    def merge(self, other: 'StageStats'):
+        '''
+        adds in the images from another StageStats, eg: from one of several
+        processes working through the same run. The run's duration stays this one's.
+        '''
+        for stage in STAGES:
+            self.totals[stage] += other.totals[stage]
+            self.counts[stage] += other.counts[stage]
+        self.latencies.extend(other.latencies)
+        self.images += other.images
+        self.failed += other.failed
+        self.tiles += other.tiles
+        self.fetch_bytes += other.fetch_bytes
+
+    def summary(self):
+        '''
+        throughput, latency percentiles, mean time per image for each stage
+        that was timed, and peak memory, as a dict that can be saved as JSON
+        '''
+        elapsed = time.perf_counter() - self.start
+        latencies = np.frombuffer(self.latencies, dtype=np.float64) if len(self.latencies) > 0 else np.zeros(1)
+        peak_rss, peak_worker_rss = peak_rss_mb()
+        summary = {
+            'images': self.images,
+            'failed': self.failed,
+            'seconds': elapsed,
+            'images_per_sec': self.images/elapsed if elapsed > 0 else 0.,
+            'latency_p50_ms': float(np.percentile(latencies, 50))*1000,
+            'latency_p99_ms': float(np.percentile(latencies, 99))*1000,
+            'fetch_mb': self.fetch_bytes/2**20,
+            'stage_ms': {stage: self.totals[stage]/self.counts[stage]*1000
+                         for stage in STAGES if self.counts[stage] > 0},
+            'peak_rss_mb': peak_rss,
+            'peak_worker_rss_mb': peak_worker_rss,
+        }
+        if self.tiles > 0:
+            summary['tiles'] = self.tiles
+            summary['tiles_per_sec'] = self.tiles/elapsed if elapsed > 0 else 0.
+        return summary
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
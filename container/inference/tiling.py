@@ -0,0 +1,134 @@
+import numpy as np
+
+from torch.utils.data import IterableDataset, get_worker_info
+from typing import List, Tuple
+
+# per-tile stage times that are added up into the image's stats
+TILE_STAGES = ['preprocess', 'model', 'loader_wait']
+# the metadata written out for each tile, after its file_path
+TILE_COLUMNS = ['tile', 'x', 'y', 'width', 'height']
+
+def tile_starts(length: int, tile_size: int, overlap: int) -> List[int]:
+    '''
+    where tiles start along one side: every tile_size - overlap pixels, with the
+    last tile moved back to end flush with the edge rather than hanging off it
+    '''
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, tile_size - overlap))
+    return starts + [length - tile_size]
+
+def tile_boxes(width: int, height: int, tile_size: int, overlap: int) -> List[Tuple[int, int, int, int]]:
+    '''
+    (left, top, right, bottom) of each tile covering a width x height image,
+    row by row. Sides shorter than tile_size get a single tile as long as the side.
+    '''
+    return [(left, top, min(left + tile_size, width), min(top + tile_size, height))
+            for top in tile_starts(height, tile_size, overlap)
+            for left in tile_starts(width, tile_size, overlap)]
+
+class TiledDataset(IterableDataset):
+    '''
+    Cuts each image from another dataset's items into overlapping tiles, so
+    full-resolution imagery can be scored without shrinking it to the model's
+    input size first. Each image is decoded once, and its tiles are NumPy views
+    of the one decoded array, so cutting them copies nothing - the image
+    processor's resize is the first copy.
+
+    Tiles come out one item per tile, in the usual {'image', 'metadata', 'stats'}
+    form. The metadata holds the tile's file_path, position and size, the
+    number of tiles in its image, and an image_id to group them by; the first
+    tile of each image also carries the image's own metadata and stats. Tiles
+    of an image that couldn't be loaded carry its error too. See
+    aggregate_tiles for putting the scores back together.
+
+    dataset: a map-style dataset (split between DataLoader workers by index),
+        or an IterableDataset that splits itself
+    block_size: a map-style dataset is split into blocks of this many images,
+        handed to the workers round-robin - the batch_size the dataset was
+        built with, so its lookahead (see fetch_utils.worker_lookahead)
+        prefetches the images this worker will actually ask for
+    '''
+    def __init__(self, dataset, tile_size: int, overlap: int = 0, block_size: int = 1):
+        if not 0 <= overlap < tile_size:
+            raise ValueError(f'tile overlap must be at least 0 and less than the tile size ({tile_size}), got {overlap}')
+        self.dataset = dataset
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.block_size = block_size
+
+    def images(self):
+        if isinstance(self.dataset, IterableDataset):
+            yield from self.dataset
+            return
+        worker = get_worker_info()
+        first, workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        for block_start in range(first*self.block_size, len(self.dataset), workers*self.block_size):
+            for i in range(block_start, min(block_start + self.block_size, len(self.dataset))):
+                yield self.dataset[i]
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id = 0 if worker is None else worker.id
+        for n, item in enumerate(self.images()):
+            pixels = np.asarray(item['image'].convert('RGB'))
+            height, width = pixels.shape[:2]
+            boxes = tile_boxes(width, height, self.tile_size, self.overlap)
+            for i, (left, top, right, bottom) in enumerate(boxes):
+                metadata = {'file_path': item['metadata']['file_path'],
+                            'image_id': (worker_id, n),
+                            'tile': i,
+                            'tiles': len(boxes),
+                            'x': left,
+                            'y': top,
+                            'width': right - left,
+                            'height': bottom - top}
+                if 'error' in item['metadata']:
+                    # a stand-in for an image that couldn't be loaded (see sources.failed_item)
+                    metadata['error'] = item['metadata']['error']
+                stats = {}
+                if i == 0:
+                    metadata['image'] = item['metadata']
+                    stats = item.get('stats', {})
+                yield {'image': pixels[top:bottom, left:right], 'metadata': metadata, 'stats': stats}
+
+def aggregate_tiles(batches, aggregate: str = 'max', on_tiles=None):
+    '''
+    Takes the (scores, metadata, stats) batches iter_score_batches yields for a
+    TiledDataset and yields them again per image, once all of an image's tiles
+    have been scored: each label's score is the max or mean over the image's
+    tiles, and the stats are the image's own with its tiles' preprocess, model
+    and loader_wait times added up, and the number of tiles under 'tiles'.
+
+    Tiles from several images share each model batch, and an image's tiles
+    can be split over several, so a batch yields the images it finished - or
+    nothing, for big images.
+
+    on_tiles: called with each batch's scores and tile metadata as they come
+        in, eg: to write out per-tile results
+    '''
+    reduce = {'max': np.max, 'mean': np.mean}[aggregate]
+    pending = {}
+    for scores, metadata, stats in batches:
+        if on_tiles is not None:
+            on_tiles(scores, metadata)
+        done_scores, done_metadata, done_stats = [], [], []
+        for tile_scores, tile, tile_stats in zip(scores, metadata, stats):
+            image = pending.setdefault(tile['image_id'], {'scores': [], 'stats': {}})
+            image['scores'].append(tile_scores)
+            if tile['tile'] == 0:
+                image['metadata'] = tile['image']
+                for stage in TILE_STAGES:
+                    tile_stats[stage] = tile_stats.get(stage, 0.) + image['stats'].get(stage, 0.)
+                image['stats'] = tile_stats
+            else:
+                for stage in TILE_STAGES:
+                    image['stats'][stage] = image['stats'].get(stage, 0.) + tile_stats.get(stage, 0.)
+            if len(image['scores']) == tile['tiles']:
+                del pending[tile['image_id']]
+                image['stats']['tiles'] = tile['tiles']
+                done_scores.append(reduce(np.stack(image['scores']), axis=0))
+                done_metadata.append(image['metadata'])
+                done_stats.append(image['stats'])
+        if len(done_metadata) > 0:
+            yield np.stack(done_scores), done_metadata, done_stats
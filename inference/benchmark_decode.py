@@ -0,0 +1,63 @@
+import argparse
+import time
+import numpy as np
+
+from pathlib import Path
+from transformers import AutoImageProcessor
+from decode_utils import open_image, model_input_size
+
+MODEL_NAME = 'MITLL/LADI-v2-classifier-small'
+
+def time_decode(paths, image_processor, draft_size=None, repeats=3):
+    '''
+    returns the CPU seconds per image spent decoding, and decoding plus running
+    the image processor, taking the best of `repeats` passes over paths
+    '''
+    decode_times = []
+    total_times = []
+    for _ in range(repeats):
+        decode_time = 0.
+        total_time = 0.
+        for path in paths:
+            start = time.process_time()
+            img = open_image(path, draft_size)
+            img = img.convert('RGB')
+            decoded = time.process_time()
+            image_processor(images=img, return_tensors='pt')
+            end = time.process_time()
+            decode_time += decoded - start
+            total_time += end - start
+        decode_times.append(decode_time/len(paths))
+        total_times.append(total_time/len(paths))
+    return min(decode_times), min(total_times)
+
+if __name__ == "__main__":
+    # compares full-resolution decoding against DCT-scaled decoding, eg:
+    # python benchmark_decode.py file_list.txt
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file_list', help='text file with one image path per line, or a directory of JPEGs')
+    parser.add_argument('--model', default=MODEL_NAME, help='model whose image processor sets the input size')
+    parser.add_argument('--limit', type=int, default=50, help='number of images to time')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    if Path(args.file_list).is_dir():
+        paths = sorted(str(p) for p in Path(args.file_list).rglob('*') if p.suffix.lower() in ['.jpg', '.jpeg'])
+    else:
+        with open(args.file_list, 'r') as f:
+            paths = [x.strip() for x in f.readlines() if x.strip()]
+    paths = paths[:args.limit]
+
+    image_processor = AutoImageProcessor.from_pretrained(args.model)
+    draft_size = model_input_size(image_processor)
+    sizes = np.array([open_image(p).size for p in paths])
+    draft_sizes = np.array([open_image(p, draft_size).size for p in paths])
+    print(f'{len(paths)} images, median size {np.median(sizes, axis=0).astype(int).tolist()}, '
+          f'model input {draft_size}px, median reduced decode size {np.median(draft_sizes, axis=0).astype(int).tolist()}')
+
+    full_decode, full_total = time_decode(paths, image_processor, None, args.repeats)
+    draft_decode, draft_total = time_decode(paths, image_processor, draft_size, args.repeats)
+    print(f'{"":>16}{"decode":>12}{"+preprocess":>14}')
+    print(f'{"full decode":>16}{full_decode*1000:>10.1f}ms{full_total*1000:>12.1f}ms')
+    print(f'{"reduced decode":>16}{draft_decode*1000:>10.1f}ms{draft_total*1000:>12.1f}ms')
+    print(f'{"speedup":>16}{full_decode/draft_decode:>11.1f}x{full_total/draft_total:>13.1f}x')
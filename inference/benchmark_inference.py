@@ -0,0 +1,198 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from PIL import Image
+
+from fetch_utils import serve_directory
+
+MODEL_NAME = 'MITLL/LADI-v2-classifier-small'
+SCENARIOS = ['files', 'http', 's3']
+BENCHMARK_BUCKET = 'ladi-benchmark'
+
+def make_image(rng, width, height):
+    '''
+    a smooth random image with a little per-pixel noise, which compresses to
+    roughly the size of a real aerial photo (6 MB or so at 6000x4000)
+    '''
+    coarse = Image.fromarray(rng.integers(0, 256, (height//100 + 1, width//100 + 1, 3), dtype=np.uint8))
+    pixels = np.asarray(coarse.resize((width, height), Image.BICUBIC), dtype=np.int16)
+    pixels += rng.integers(-12, 12, pixels.shape, dtype=np.int16)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+def make_exif(rng, when):
+    '''
+    EXIF with a GPS position somewhere in CONUS and a DateTimeOriginal, the
+    tags metadata_utils reads
+    '''
+    def dms(x):
+        minutes, seconds = divmod(x*3600, 60)
+        degrees, minutes = divmod(minutes, 60)
+        return (float(degrees), float(minutes), round(seconds, 2))
+
+    exif = Image.Exif()
+    exif[0x8825] = {1: 'N', 2: dms(rng.uniform(25, 49)), 3: 'W', 4: dms(rng.uniform(67, 125))}
+    exif[0x8769] = {0x9003: when.strftime('%Y:%m:%d %H:%M:%S')}
+    return exif
+
+def make_corpus(root, count=100, width=6000, height=4000, quality=90, seed=0):
+    '''
+    writes count EXIF-tagged JPEGs to root, skipping any that are already
+    there so the corpus can be reused between runs
+    '''
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    start = datetime(2024, 5, 1, 12)
+    paths = []
+    for i in range(count):
+        path = root/f'{i:05}.jpg'
+        paths.append(path)
+        if path.exists():
+            continue
+        img = make_image(rng, width, height)
+        img.save(path, quality=quality, exif=make_exif(rng, start + timedelta(seconds=5*i)))
+    return paths
+
+def start_s3(root, paths, endpoint=None):
+    '''
+    uploads the corpus to a local S3 stand-in: the one at endpoint if given
+    (eg: MinIO, using your AWS credentials), otherwise an in-process moto
+    server. Returns the endpoint, the prefix URL, and the moto server or None.
+    '''
+    import boto3
+
+    server = None
+    if endpoint is None:
+        # moto is only needed for this scenario
+        from moto.server import ThreadedMotoServer
+        for key in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+            os.environ.setdefault(key, 'benchmark')
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        server = ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+        server.start()
+        endpoint = f'http://127.0.0.1:{server.get_host_and_port()[1]}'
+    client = boto3.client('s3', endpoint_url=endpoint)
+    client.create_bucket(Bucket=BENCHMARK_BUCKET)
+    for path in paths:
+        client.upload_file(str(path), BENCHMARK_BUCKET, f'corpus/{path.relative_to(root).as_posix()}')
+    return endpoint, f's3://{BENCHMARK_BUCKET}/corpus/', server
+
+def run_engine(source, inputs, engine_args, workdir):
+    '''
+    runs infer_engine.py in its own process, so its peak memory is its own,
+    and returns the --stats-json summary
+    '''
+    stats_path = Path(workdir)/f'{source}_stats.json'
+    command = [sys.executable, str(Path(__file__).parent/'infer_engine.py'), source, *inputs,
+               '--output', str(Path(workdir)/f'{source}_outputs.csv'),
+               '--stats-json', str(stats_path), *engine_args]
+    subprocess.run(command, check=True)
+    with open(stats_path, 'r') as f:
+        return json.load(f)
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results, baseline=None):
+    stages = ['fetch', 'decode', 'preprocess', 'model', 'postprocess', 'write']
+    print(f'{"":>8}{"img/s":>9}{"p50 ms":>9}{"p99 ms":>9}{"RSS MB":>9}' + ''.join(f'{x:>12}' for x in stages))
+    for name, result in results.items():
+        stage_ms = result['stage_ms']
+        print(f'{name:>8}{result["images_per_sec"]:>9.1f}{result["latency_p50_ms"]:>9.0f}{result["latency_p99_ms"]:>9.0f}'
+              f'{result["peak_rss_mb"] or 0:>9.0f}' + ''.join(f'{stage_ms.get(x, float("nan")):>12.1f}' for x in stages))
+        if baseline is not None and name in baseline['results']:
+            old = baseline['results'][name]
+            print(f'{"":>8}{result["images_per_sec"]/old["images_per_sec"]:>8.2f}x'
+                  f'{result["latency_p50_ms"]/old["latency_p50_ms"]:>8.2f}x{result["latency_p99_ms"]/old["latency_p99_ms"]:>8.2f}x'
+                  f'{(result["peak_rss_mb"] or 0)/(old["peak_rss_mb"] or 1):>8.2f}x  vs {baseline.get("git_commit") or "baseline"}')
+
+if __name__ == "__main__":
+    # runs infer_engine.py end to end over a synthetic corpus of large EXIF-tagged
+    # JPEGs, from local files, a local HTTP server and a local S3 stand-in, eg:
+    # python benchmark_inference.py --corpus /tmp/ladi_corpus --count 200 --output bench.json -- --reduced-decode
+    # anything after -- is passed on to infer_engine.py. Per-stage times are the
+    # mean seconds spent per image in each stage, summed over all workers.
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus', default=os.path.join(tempfile.gettempdir(), 'ladi_benchmark_corpus'),
+                        help='directory for the synthetic images, reused if it already has them')
+    parser.add_argument('--count', type=int, default=100, help='number of images')
+    parser.add_argument('--size', default='6000x4000', help='image size, WIDTHxHEIGHT')
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument('--model', default=MODEL_NAME)
+    parser.add_argument('--batch-size', type=int, default=12)
+    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument('--http-latency', type=float, default=0.05, help='seconds the HTTP server waits before each response')
+    parser.add_argument('--s3-endpoint', default=None, help='an S3 stand-in to use instead of starting moto')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to save the results as JSON')
+    parser.add_argument('--baseline', default=None, help='results JSON from an earlier run to compare against')
+    args, engine_args = parser.parse_known_args()
+    engine_args = [x for x in engine_args if x != '--']
+    engine_args += ['--model', args.model, '--batch-size', str(args.batch_size), '--num-workers', str(args.num_workers)]
+
+    width, height = [int(x) for x in args.size.split('x')]
+    corpus = Path(args.corpus)
+    start = time.perf_counter()
+    paths = make_corpus(corpus, args.count, width, height)
+    print(f'{len(paths)} {args.size} images in {corpus} ({sum(p.stat().st_size for p in paths)/2**20:.0f} MB), '
+          f'ready in {time.perf_counter() - start:.1f}s')
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for scenario in args.scenarios:
+            print(f'running {scenario}')
+            if scenario == 'files':
+                list_path = Path(workdir)/'file_list.txt'
+                list_path.write_text('\n'.join(str(p) for p in paths))
+                results[scenario] = run_engine('files', [str(list_path)], engine_args, workdir)
+            elif scenario == 'http':
+                server, base_url = serve_directory(corpus, latency=args.http_latency)
+                list_path = Path(workdir)/'url_list.txt'
+                list_path.write_text('\n'.join(f'{base_url}/{p.relative_to(corpus).as_posix()}' for p in paths))
+                try:
+                    results[scenario] = run_engine('urls', [str(list_path)], engine_args, workdir)
+                finally:
+                    server.shutdown()
+            elif scenario == 's3':
+                endpoint, prefix_url, server = start_s3(corpus, paths, args.s3_endpoint)
+                try:
+                    results[scenario] = run_engine('s3', [prefix_url, '--s3-endpoint', endpoint, '--s3-signed'],
+                                                   engine_args, workdir)
+                finally:
+                    if server is not None:
+                        server.stop()
+
+    report = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'corpus': {'count': len(paths), 'size': args.size, 'mb': sum(p.stat().st_size for p in paths)/2**20},
+        'engine_args': engine_args,
+        'http_latency': args.http_latency,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    print(f'saved to {args.output}')
@@ -0,0 +1,21 @@
+from PIL import Image
+
+def model_input_size(image_processor):
+    '''
+    the length of the shorter side of the images image_processor hands the model
+    '''
+    if "shortest_edge" in image_processor.size:
+        return image_processor.size["shortest_edge"]
+    return min(image_processor.size["height"], image_processor.size["width"])
+
+def open_image(fp, draft_size: int = None):
+    '''
+    Opens an image like Image.open. If draft_size is given and the image is a
+    JPEG, libjpeg is told to decode it at the smallest of the 1/8, 1/4 or 1/2
+    DCT scales that keeps both sides at least draft_size pixels, which skips
+    most of the decode work for images far bigger than the model input.
+    '''
+    img = Image.open(fp)
+    if draft_size is not None and img.format == 'JPEG':
+        img.draft('RGB', (draft_size, draft_size))
+    return img
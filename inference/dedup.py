@@ -0,0 +1,154 @@
+import hashlib
+import os
+import numpy as np
+
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from PIL import Image
+from typing import Dict, List
+
+from decode_utils import open_image
+
+def partial_hash(path, chunk_size=65536):
+    '''
+    blake2b of the first and last chunk_size bytes of a file, which tells most
+    same-sized files apart without reading all of them
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    try:
+        with open(path, 'rb') as f:
+            h.update(f.read(chunk_size))
+            f.seek(0, os.SEEK_END)
+            if f.tell() > chunk_size:
+                f.seek(max(chunk_size, f.tell() - chunk_size))
+                h.update(f.read(chunk_size))
+    except OSError:
+        return None
+    return h.hexdigest()
+
+def full_hash(path, chunk_size=1 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    try:
+        with open(path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                h.update(chunk)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+def group_duplicates(keys: List[str], group_ids: List) -> Dict[str, str]:
+    '''
+    maps every key after the first in each group of keys with the same
+    group_id (None never matches) to that first key. A key listed more than
+    once isn't a duplicate of itself.
+    '''
+    canonical = {}
+    duplicates = {}
+    for key, group_id in zip(keys, group_ids):
+        if group_id is None:
+            continue
+        if group_id in canonical:
+            if canonical[group_id] != key:
+                duplicates[key] = canonical[group_id]
+        else:
+            canonical[group_id] = key
+    return duplicates
+
+def refine(groups: Dict, hash_fn, processes=None) -> Dict:
+    '''
+    splits each group of keys with more than one member by hash_fn, hashing
+    only the keys that could still be duplicates
+    '''
+    candidates = [key for keys in groups.values() if len(keys) > 1 for key in keys]
+    with ThreadPool(processes or os.cpu_count()) as p:
+        hashes = dict(zip(candidates, p.map(hash_fn, candidates, chunksize=16)))
+    refined = defaultdict(list)
+    for group_id, keys in groups.items():
+        for key in keys:
+            if len(keys) > 1 and hashes[key] is not None:
+                refined[(group_id, hashes[key])].append(key)
+    return refined
+
+def file_duplicates(paths: List[str], processes=None) -> Dict[str, str]:
+    '''
+    Finds local files with identical contents, in three passes that each only
+    look at files the last one couldn't tell apart: file size, then a hash of
+    the first and last 64 KB, then a hash of the whole file.
+
+    Returns {duplicate path: canonical path}, where the canonical path is the
+    first of its group in the order given.
+    '''
+    sizes = defaultdict(list)
+    for path in paths:
+        try:
+            sizes[os.stat(path).st_size].append(path)
+        except OSError:
+            pass
+    groups = refine(sizes, partial_hash, processes)
+    groups = refine(groups, full_hash, processes)
+    group_ids = {key: group_id for group_id, keys in groups.items() for key in keys}
+    return group_duplicates(paths, [group_ids.get(path) for path in paths])
+
+def etag_duplicates(keys: List[str], etags: Dict[str, str], sizes: Dict[str, int]) -> Dict[str, str]:
+    '''
+    Finds S3 objects with identical contents from their listing alone: the
+    same size and ETag (the MD5 of the contents for single-part uploads).
+
+    Returns {duplicate key: canonical key}, as file_duplicates does.
+    '''
+    return group_duplicates(keys, [(sizes.get(key), etags.get(key)) if key in etags else None for key in keys])
+
+def dhash(path, hash_size: int = 8):
+    '''
+    64-bit difference hash: whether each pixel of a (hash_size+1) x hash_size
+    grayscale thumbnail is brighter than its left neighbour. Re-encoded,
+    resized or slightly recoloured copies of an image hash the same or within
+    a few bits. JPEGs are decoded at full size like every other format, since
+    a reduced-scale decode shifts the thumbnail enough that a PNG copy of a
+    JPEG would hash differently.
+    '''
+    try:
+        img = open_image(path).convert('L')
+    except OSError:
+        return None
+    pixels = np.asarray(img.resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    return int.from_bytes(np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes(), 'big')
+
+def perceptual_duplicates(paths: List[str], max_distance: int = 0, processes=None) -> Dict[str, str]:
+    '''
+    Finds near-identical images: ones whose dhash differs in at most
+    max_distance bits. Hashes are split into max_distance+1 bands, and any two
+    within max_distance bits must match exactly on at least one of them, so
+    only images sharing a band get compared.
+
+    Returns {duplicate path: canonical path}, with chains of near-duplicates
+    going to the first image of the chain in the order given.
+    '''
+    with ThreadPool(processes or os.cpu_count()) as p:
+        hashes = p.map(dhash, paths, chunksize=16)
+    parent = list(range(len(paths)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    bands = max_distance + 1
+    edges = [64*band//bands for band in range(bands + 1)]
+    for band in range(bands):
+        width = edges[band+1] - edges[band]
+        buckets = defaultdict(list)
+        for i, h in enumerate(hashes):
+            if h is not None:
+                buckets[(h >> (64 - edges[band+1])) & ((1 << width) - 1)].append(i)
+        for members in buckets.values():
+            for j in members[1:]:
+                for i in members:
+                    if i >= j:
+                        break
+                    if bin(hashes[i] ^ hashes[j]).count('1') <= max_distance:
+                        # the root is always the earliest image of the chain
+                        a, b = find(i), find(j)
+                        parent[max(a, b)] = min(a, b)
+    return {paths[i]: paths[find(i)] for i in range(len(paths)) if paths[find(i)] != paths[i]}
@@ -0,0 +1,135 @@
+import argparse
+import time
+import numpy as np
+import torch
+
+from pathlib import Path
+from transformers import AutoImageProcessor, AutoModelForImageClassification
+
+from decode_utils import model_input_size, open_image
+from onnx_backend import ONNXImageClassifier
+
+MODEL_NAME = 'MITLL/LADI-v2-classifier-small'
+
+def export_onnx(model, output_dir, size: int, opset: int = 17):
+    '''
+    exports model to output_dir/model.onnx with a variable batch size, taking
+    size x size pixel_values and returning logits
+    '''
+    model = model.eval().cpu()
+    dummy = torch.zeros(1, 3, size, size)
+    onnx_path = Path(output_dir)/'model.onnx'
+    torch.onnx.export(model, (dummy,), str(onnx_path),
+                      input_names=['pixel_values'],
+                      output_names=['logits'],
+                      dynamic_axes={'pixel_values': {0: 'batch'}, 'logits': {0: 'batch'}},
+                      opset_version=opset,
+                      dynamo=False)
+    return onnx_path
+
+def quantize_onnx(onnx_path):
+    '''
+    writes a copy of onnx_path next to it with its weights dynamically
+    quantized to int8, eg: model.onnx -> model.int8.onnx
+    '''
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    int8_path = Path(onnx_path).with_suffix('.int8.onnx')
+    quantize_dynamic(str(onnx_path), str(int8_path), weight_type=QuantType.QInt8)
+    return int8_path
+
+def load_batches(image_processor, image_list=None, limit=64, batch_size=8, size=224):
+    '''
+    preprocessed pixel_values batches for the parity check and benchmark, from
+    image_list (a text file with one path per line, or a directory of JPEGs),
+    or random pixels if image_list is None
+    '''
+    if image_list is None:
+        generator = torch.Generator().manual_seed(0)
+        pixels = torch.randn(limit, 3, size, size, generator=generator)
+    else:
+        if Path(image_list).is_dir():
+            paths = sorted(str(p) for p in Path(image_list).rglob('*') if p.suffix.lower() in ['.jpg', '.jpeg'])
+        else:
+            with open(image_list, 'r') as f:
+                paths = [x.strip() for x in f.readlines() if x.strip()]
+        paths = paths[:limit]
+        images = [open_image(p).convert('RGB') for p in paths]
+        pixels = image_processor(images=images, return_tensors='pt')['pixel_values']
+    return list(torch.split(pixels, batch_size))
+
+def score_batches(model, batches):
+    '''
+    sigmoid scores for every image in batches, and the images per second it took
+    '''
+    scores = []
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for pixel_values in batches:
+            scores.append(torch.sigmoid(model(pixel_values=pixel_values).logits.float()).numpy())
+    elapsed = time.perf_counter() - start
+    return np.concatenate(scores), sum(len(x) for x in batches)/elapsed
+
+def parity_report(labels, reference, scores, threshold=0.5):
+    '''
+    per-label max and mean absolute score differences against reference, and
+    how many images land on the other side of threshold
+    '''
+    delta = np.abs(scores - reference)
+    flips = ((scores >= threshold) != (reference >= threshold)).sum(axis=0)
+    lines = [f'{"label":>32}{"max delta":>12}{"mean delta":>12}{"flips":>8}']
+    for i, label in enumerate(labels):
+        lines.append(f'{label:>32}{delta[:, i].max():>12.5f}{delta[:, i].mean():>12.5f}{flips[i]:>8}')
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+    # exports the classifier for CPU inference with ONNX Runtime, then checks the
+    # exported models against PyTorch, eg:
+    # python export_onnx.py MITLL/LADI-v2-classifier-small onnx_model --quantize --images file_list.txt
+    # the result can then be used with: python infer_engine.py ... --onnx onnx_model/model.int8.onnx
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', help=f'model name on the Hub, eg: {MODEL_NAME}, or a checkpoint directory saved by training/train.py')
+    parser.add_argument('output_dir', help='where to write model.onnx, its config and image processor')
+    parser.add_argument('--quantize', action='store_true', help='also write model.int8.onnx with int8 weights')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--images', default=None,
+                        help='text file with one image path per line, or a directory of JPEGs, to check and '
+                             'time the export on. Random pixels are used if not given')
+    parser.add_argument('--limit', type=int, default=64, help='number of images to check')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads for both PyTorch and ONNX Runtime')
+    args = parser.parse_args()
+
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    model = AutoModelForImageClassification.from_pretrained(args.model).eval()
+    image_processor = AutoImageProcessor.from_pretrained(args.model)
+    # the config and image processor go next to the .onnx files so onnx_backend can load them from there
+    model.config.save_pretrained(args.output_dir)
+    image_processor.save_pretrained(args.output_dir)
+
+    size = model_input_size(image_processor)
+    onnx_paths = [export_onnx(model, args.output_dir, size, args.opset)]
+    if args.quantize:
+        onnx_paths.append(quantize_onnx(onnx_paths[0]))
+    for onnx_path in onnx_paths:
+        print(f'wrote {onnx_path} ({onnx_path.stat().st_size/2**20:.1f} MB)')
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    labels = [model.config.id2label[i] for i in range(model.config.num_labels)]
+    batches = load_batches(image_processor, args.images, args.limit, args.batch_size, size)
+    # one untimed pass each, so lazy initialization doesn't count against either side
+    score_batches(model, batches[:1])
+    reference, reference_speed = score_batches(model, batches)
+    speeds = [('pytorch', reference_speed)]
+    for onnx_path in onnx_paths:
+        onnx_model = ONNXImageClassifier(onnx_path, model.config, args.threads)
+        score_batches(onnx_model, batches[:1])
+        scores, speed = score_batches(onnx_model, batches)
+        speeds.append((onnx_path.name, speed))
+        print(f'\n{onnx_path.name} vs pytorch, {len(reference)} images')
+        print(parity_report(labels, reference, scores))
+
+    print(f'\n{"":>16}{"images/sec":>12}{"speedup":>10}')
+    for name, speed in speeds:
+        print(f'{name:>16}{speed:>12.1f}{speed/reference_speed:>9.2f}x')
@@ -5,6 +5,7 @@ from PIL.ExifTags import TAGS, GPSTAGS
 from multiprocessing.pool import ThreadPool
 import numpy as np
 import pathlib
+import struct
 import tqdm
 import argparse
 import pandas as pd
@@ -94,18 +95,157 @@ def get_metadata_entry(img_path):
         return
     return {'file_path': img_path, **get_metadata_img(img)}
 
+# header-only EXIF reading: instead of opening the whole image with PIL and
+# walking every tag, read the start of the JPEG, find the APP1 (EXIF) segment
+# and pull out just the GPS position and DateTimeOriginal
+EXIF_HEADER = b'Exif\x00\x00'
+EXIF_IFD_TAG = 0x8769
+GPS_IFD_TAG = 0x8825
+DATETIME_ORIGINAL_TAG = 0x9003
+GPS_LAT_REF_TAG, GPS_LAT_TAG, GPS_LON_REF_TAG, GPS_LON_TAG = 1, 2, 3, 4
+# sizes in bytes of the TIFF field types, keyed by type id
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+
+def find_exif_segment(data, read=None, chunk_size=16384):
+    """
+    Walks the JPEG markers at the start of data and returns the TIFF payload of
+    the EXIF APP1 segment, or None if there isn't one before the image data.
+    read is called to get more bytes when the segment runs past the end of data.
+    """
+    if data[:2] != b'\xff\xd8':
+        return None
+    pos = 2
+    while True:
+        while pos + 4 > len(data) or (data[pos+1] == 0xE1 and pos + 2 + struct.unpack('>H', data[pos+2:pos+4])[0] > len(data)):
+            more = read(chunk_size) if read is not None else b''
+            if not more:
+                return None
+            data += more
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos+1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker in (0xDA, 0xD9):
+            # reached the image data (or the end of the file)
+            return None
+        end = pos + 2 + struct.unpack('>H', data[pos+2:pos+4])[0]
+        if marker == 0xE1 and data[pos+4:pos+10] == EXIF_HEADER:
+            return data[pos+10:end]
+        pos = end
+
+def read_ifd(tiff, offset, endian, tags):
+    """
+    returns {tag: raw value bytes} for the requested tags of the IFD at offset
+    """
+    entries = {}
+    count, = struct.unpack(endian + 'H', tiff[offset:offset+2])
+    for entry in range(offset + 2, offset + 2 + 12*count, 12):
+        tag, field_type, n = struct.unpack(endian + 'HHI', tiff[entry:entry+8])
+        if tag not in tags:
+            continue
+        size = TIFF_TYPE_SIZES.get(field_type, 1) * n
+        if size <= 4:
+            entries[tag] = tiff[entry+8:entry+8+size]
+        else:
+            value_offset, = struct.unpack(endian + 'I', tiff[entry+8:entry+12])
+            entries[tag] = tiff[value_offset:value_offset+size]
+    return entries
+
+def decode_gps_coord(value, endian):
+    """
+    converts three EXIF rationals (degrees, minutes, seconds) into decimal degrees
+    """
+    nums = struct.unpack(endian + '6I', value[:24])
+    degs, mins, secs = [num/den if den else np.nan for num, den in zip(nums[0::2], nums[1::2])]
+    return degs + mins/60 + secs/3600
+
+def parse_exif_segment(tiff):
+    """
+    Decodes lat, lon and DateTimeOriginal from the TIFF payload of an EXIF segment.
+    Returns the same dict as get_metadata_img, with None for anything missing.
+    """
+    output = {'lat': None, 'lon': None, 'timestamp': None}
+    if tiff is None or tiff[:2] not in (b'II', b'MM'):
+        return output
+    endian = '<' if tiff[:2] == b'II' else '>'
+    try:
+        ifd0_offset, = struct.unpack(endian + 'I', tiff[4:8])
+        ifd0 = read_ifd(tiff, ifd0_offset, endian, (EXIF_IFD_TAG, GPS_IFD_TAG))
+        if EXIF_IFD_TAG in ifd0:
+            exif_ifd = read_ifd(tiff, struct.unpack(endian + 'I', ifd0[EXIF_IFD_TAG])[0],
+                                endian, (DATETIME_ORIGINAL_TAG,))
+            if DATETIME_ORIGINAL_TAG in exif_ifd:
+                output['timestamp'] = exif_ifd[DATETIME_ORIGINAL_TAG].rstrip(b'\x00').decode('ascii', errors='replace')
+        if GPS_IFD_TAG in ifd0:
+            gps_ifd = read_ifd(tiff, struct.unpack(endian + 'I', ifd0[GPS_IFD_TAG])[0], endian,
+                               (GPS_LAT_REF_TAG, GPS_LAT_TAG, GPS_LON_REF_TAG, GPS_LON_TAG))
+            if GPS_LAT_TAG in gps_ifd:
+                output['lat'] = decode_gps_coord(gps_ifd[GPS_LAT_TAG], endian)
+                if gps_ifd.get(GPS_LAT_REF_TAG, b'')[:1] == b'S':
+                    output['lat'] *= -1
+            if GPS_LON_TAG in gps_ifd:
+                output['lon'] = decode_gps_coord(gps_ifd[GPS_LON_TAG], endian)
+                if gps_ifd.get(GPS_LON_REF_TAG, b'')[:1] == b'W':
+                    output['lon'] *= -1
+    except (struct.error, IndexError):
+        pass
+    return output
+
+def get_metadata_bytes(data):
+    """
+    header-only equivalent of get_metadata_img for an image that's already in memory
+    """
+    return parse_exif_segment(find_exif_segment(data))
+
+def get_metadata_stream(read, chunk_size=16384):
+    """
+    header-only metadata from a stream, eg: the body of an S3 object, read
+    only until the end of its EXIF segment
+    """
+    return parse_exif_segment(find_exif_segment(read(chunk_size), read, chunk_size))
+
+def get_metadata_fast(img_path, chunk_size=16384):
+    """
+    header-only equivalent of get_metadata_entry - reads only as much of the
+    file as it takes to get to the end of the EXIF segment. Falls back to
+    get_metadata_entry for files that aren't JPEGs.
+    """
+    try:
+        with open(img_path, 'rb', buffering=0) as f:
+            head = f.read(chunk_size)
+            if head[:2] != b'\xff\xd8':
+                return get_metadata_entry(img_path)
+            return {'file_path': img_path, **parse_exif_segment(find_exif_segment(head, f.read, chunk_size))}
+    except OSError:
+        return
+
+def get_metadata_columns(img_paths, processes=None):
+    """
+    Runs get_metadata_fast over img_paths on a thread pool and returns the results
+    as columns: file_path (object), lat and lon (float64, NaN when missing) and
+    timestamp (datetime64, NaT when missing or unparseable).
+    """
+    with ThreadPool(processes or os.cpu_count()) as p:
+        entries = p.map(get_metadata_fast, img_paths, chunksize=256)
+    missing = {'lat': None, 'lon': None, 'timestamp': None}
+    entries = [missing if x is None else x for x in entries]
+    columns = {'file_path': np.array(img_paths, dtype=object)}
+    for key in ['lat', 'lon']:
+        columns[key] = np.array([np.nan if x[key] is None else x[key] for x in entries], dtype=np.float64)
+    columns['timestamp'] = pd.to_datetime(pd.Series([x['timestamp'] for x in entries], dtype=object),
+                                          format='%Y:%m:%d %H:%M:%S', errors='coerce').to_numpy()
+    return columns
+
 
 if __name__=="__main__":
     with open('./file_list.txt','r') as img_path_file:
         img_paths_list = img_path_file.read().splitlines()
     img_paths_list = [x for x in img_paths_list if x.split('.')[-1].lower() in ['png','jpg','jpeg']]
-    worker_img_paths_list = img_paths_list
-    with ThreadPool(os.cpu_count()) as p:
-        output_list = p.map(get_metadata_entry, worker_img_paths_list)
-    output_list = [x for x in output_list if x is not None]
-    output_df = pd.DataFrame(output_list)
+    # unreadable files and files without a position or a valid DateTimeOriginal
+    # (eg: 0000:00:00 00:00:00) come back as NaN/NaT and are dropped here
+    output_df = pd.DataFrame(get_metadata_columns(img_paths_list))
     output_df = output_df.dropna()
-    output_df = output_df.loc[output_df['timestamp']!='0000:00:00 00:00:00']
-    output_df['timestamp'] = pd.to_datetime(output_df['timestamp'], format='%Y:%m:%d %H:%M:%S')
     output_df.to_csv(f'outputs.csv', index=False)
-
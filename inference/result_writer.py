@@ -0,0 +1,160 @@
+import os
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+from typing import List
+
+# fixed types for the metadata columns, so every chunk has the same schema even
+# when none of its images happen to have EXIF
+METADATA_DTYPES = {'lat': np.float64, 'lon': np.float64, 'timestamp': 'string'}
+
+def score_rows(metadata: List[dict], scores: np.ndarray, labels: List[str]):
+    '''
+    turns a batch from write_scores' arguments back into one row dict per image,
+    with the same column order as write_scores
+    '''
+    order = np.argsort(labels)
+    for img_metadata, img_scores in zip(metadata, scores.tolist()):
+        img_metadata = dict(img_metadata)
+        yield {'file_path': img_metadata.pop('file_path'), **{labels[i]: img_scores[i] for i in order}, **img_metadata}
+
+class ResultWriter:
+    '''
+    Streams inference results to disk in fixed-size chunks so memory stays flat
+    however many images a run covers, and a crashed run still leaves every
+    completed chunk behind.
+
+    path: where to write. A path ending in .parquet is written as a directory of
+        part-NNNNN.parquet files (one per chunk, readable with pd.read_parquet),
+        anything else as a single CSV file
+    chunk_size: how many rows to buffer before writing them out and fsyncing
+    score_columns: columns to store as float32, normally the label names
+    '''
+    def __init__(self,
+                 path: str,
+                 chunk_size: int = 1000,
+                 score_columns: List[str] = None):
+        self.path = Path(path)
+        self.chunk_size = chunk_size
+        self.score_columns = [] if score_columns is None else list(score_columns)
+        self.format = 'parquet' if self.path.suffix == '.parquet' else 'csv'
+        self.columns = None
+        # the buffered chunk, in the order it was written: frames holds whole
+        # DataFrames, and rows the dict rows written since the last of them
+        self.rows = []
+        self.frames = []
+        self.buffered = 0
+        self.chunks_written = 0
+        self.rows_written = 0
+        if self.format == 'parquet':
+            self.path.mkdir(parents=True, exist_ok=True)
+            for old_part in self.path.glob('part-*.parquet'):
+                old_part.unlink()
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, row: dict):
+        self.rows.append(row)
+        self.buffered += 1
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def write_scores(self, metadata: List[dict], scores: np.ndarray, labels: List[str]):
+        '''
+        columnar version of write for a whole batch: metadata holds one dict per
+        image (including file_path), scores is an (images, labels) array whose
+        columns line up with labels. Columns come out in the same order as rows
+        from write - file_path, the labels sorted by name, then the metadata.
+        '''
+        if len(metadata) == 0:
+            return
+        columns = {'file_path': [x['file_path'] for x in metadata]}
+        for i in np.argsort(labels):
+            columns[labels[i]] = scores[:, i]
+        for key in metadata[0].keys():
+            if key != 'file_path':
+                columns[key] = [x[key] for x in metadata]
+        self.append_frame(pd.DataFrame(columns))
+        self.buffered += len(metadata)
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def write_frame(self, df: pd.DataFrame):
+        '''
+        writes rows that are already in a DataFrame with the usual columns, eg:
+        results read back from another ResultWriter's CSV
+        '''
+        if len(df) == 0:
+            return
+        self.append_frame(df)
+        self.buffered += len(df)
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def frame_rows(self):
+        '''
+        turns the dict rows written since the last DataFrame into one
+        '''
+        if len(self.rows) > 0:
+            self.frames.append(pd.DataFrame(data=self.rows))
+            self.rows = []
+
+    def append_frame(self, df: pd.DataFrame):
+        '''
+        adds df to the buffered chunk after any dict rows written before it, so
+        rows come out in the order they were written
+        '''
+        self.frame_rows()
+        self.frames.append(df)
+
+    def to_frame(self):
+        '''
+        builds the DataFrame for the buffered chunk, with the column order fixed by the first chunk
+        '''
+        self.frame_rows()
+        frames = self.frames
+        df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+        if self.columns is None:
+            self.columns = list(df.columns)
+        df = df.reindex(columns=self.columns)
+        for col in self.score_columns:
+            if col in df.columns:
+                df[col] = df[col].astype(np.float32)
+        for col, dtype in METADATA_DTYPES.items():
+            if col in df.columns:
+                df[col] = df[col].astype(dtype)
+        return df
+
+    def flush(self):
+        if self.buffered == 0:
+            return
+        df = self.to_frame()
+        if self.format == 'parquet':
+            part_path = self.path/f'part-{self.chunks_written:05}.parquet'
+            tmp_path = part_path.with_suffix('.tmp')
+            df.to_parquet(tmp_path, index=False)
+            with open(tmp_path, 'rb') as f:
+                os.fsync(f.fileno())
+            # parts only show up once they're complete
+            os.replace(tmp_path, part_path)
+        else:
+            with open(self.path, 'a', newline='') as f:
+                df.to_csv(f, header=self.chunks_written == 0, index=False)
+                f.flush()
+                os.fsync(f.fileno())
+        self.chunks_written += 1
+        self.rows_written += self.buffered
+        self.rows = []
+        self.frames = []
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
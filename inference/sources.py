@@ -0,0 +1,478 @@
+import multiprocessing
+import os
+import queue
+import time
+
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+from PIL import Image
+from threading import Thread
+from torch.utils.data import Dataset, IterableDataset
+from typing import Dict, Iterable, List, Tuple, Union
+
+from metadata_utils import get_metadata_bytes, get_metadata_fast, get_metadata_stream
+from decode_utils import open_image
+from fetch_utils import HTTPFetcher, S3Fetcher, split_s3_url, worker_lookahead
+from result_cache import ResultCache, file_fingerprint
+from dedup import etag_duplicates, file_duplicates, perceptual_duplicates
+from scan_utils import SCAN_THREADS, existing_files, scan_tree
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+# side of the blank image that stands in for one that couldn't be loaded
+FAILED_IMAGE_SIZE = 32
+
+def image_item(key, data, draft_size, start, fetched, fetcher):
+    '''
+    decodes downloaded image bytes into the item the pipeline expects. The
+    metadata goes through the pipeline with the image, and so do the stage
+    timings (see stage_stats.py)
+    '''
+    img = open_image(BytesIO(data), draft_size)
+    img.load()
+    stats = {'start': start, 'fetch': fetched - start, 'fetch_bytes': len(data), 'decode': time.time() - fetched,
+             'fetch_in_flight': fetcher.in_flight}
+    return {'image': img, 'metadata': {'file_path': key, **get_metadata_bytes(data)}, 'stats': stats}
+
+def failed_item(key, error, start):
+    '''
+    stands in for an image that couldn't be downloaded or decoded, so one bad
+    key doesn't take the DataLoader, and with it the whole run, down. It goes
+    through the model as a small blank image, but its metadata carries the
+    error, and the engine reports it and leaves it out of the results
+    '''
+    return {'image': Image.new('RGB', (FAILED_IMAGE_SIZE, FAILED_IMAGE_SIZE)),
+            'metadata': {'file_path': key, 'error': str(error), 'error_type': type(error).__name__},
+            'stats': {'start': start}}
+
+class FileListDataset(Dataset):
+    def __init__(self, paths: Union[List[str], str], draft_size: int = None, extensions: List[str] = IMAGE_EXTENSIONS,
+                 min_size: int = 0, max_size: int = None, checked: bool = False, threads: int = SCAN_THREADS):
+        """
+        paths: the image files to run inference on, or a directory to find them
+            in. Missing files are dropped, checking the paths in parallel
+        draft_size: if set, JPEGs are decoded at a reduced scale that keeps both
+            sides at least this big (see decode_utils.open_image)
+        extensions: when paths is a directory, the extensions of the files to use
+        min_size, max_size: leave out files smaller or larger than this many bytes
+        checked: paths is a list that's already known to exist and pass the size
+            filters (eg: from scan_utils.scan_tree), so it isn't checked again
+        threads: how many directory listings or stats to have in flight at once
+        """
+        if isinstance(paths, (str, os.PathLike)):
+            paths = scan_tree([paths], extensions, min_size, max_size, threads)
+        elif not checked:
+            paths = existing_files(paths, min_size, max_size, threads)
+        self.paths = paths
+        self.draft_size = draft_size
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        start = time.time()
+        try:
+            img = open_image(Path(self.paths[idx]), self.draft_size)
+            img.load()
+        except Exception as e:
+            return failed_item(self.paths[idx], e, start)
+        decoded = time.time()
+        metadata = get_metadata_fast(self.paths[idx])
+        # the metadata goes through the pipeline with the image, and so do the
+        # stage timings (see stage_stats.py)
+        return {'image': img, 'metadata': metadata, 'stats': {'start': start, 'decode': decoded - start}}
+
+class URLListDataset(Dataset):
+    def __init__(self, urls: List[str], batch_size: int = 1, fetcher: HTTPFetcher = None, draft_size: int = None):
+        """
+        urls: the image URLs to run inference on
+        batch_size: the batch size the pipeline is run with, used to work out
+            which images each DataLoader worker should download ahead of time
+        fetcher: the HTTPFetcher used for downloads - defaults to one with 8
+            concurrent requests and 16 images of lookahead per worker
+        draft_size: if set, JPEGs are decoded at a reduced scale that keeps both
+            sides at least this big (see decode_utils.open_image)
+        """
+        self.urls = urls
+        self.draft_size = draft_size
+        self.batch_size = batch_size
+        self.fetcher = HTTPFetcher() if fetcher is None else fetcher
+
+    def __len__(self):
+        return len(self.urls)
+
+    def __getitem__(self, idx):
+        url = self.urls[idx]
+
+        start = time.time()
+        upcoming = worker_lookahead(idx, self.fetcher.prefetch, self.batch_size, len(self.urls))
+        try:
+            data = self.fetcher.get(self.urls, upcoming)
+            return image_item(url, data, self.draft_size, start, time.time(), self.fetcher)
+        except Exception as e:
+            # eg: a 404, or a page that isn't an image
+            return failed_item(url, e, start)
+
+class AWSListDataset(Dataset):
+    def __init__(self, urls: List[str], batch_size: int = 1, fetcher: S3Fetcher = None, draft_size: int = None):
+        """
+        urls: the s3://bucket/key URLs to run inference on
+        batch_size: the batch size the pipeline is run with, used to work out
+            which objects each DataLoader worker should download ahead of time
+        fetcher: the S3Fetcher used for downloads - defaults to 8 GETs in flight
+            and 16 objects of lookahead per worker, with ranged GETs for large objects
+        draft_size: if set, JPEGs are decoded at a reduced scale that keeps both
+            sides at least this big (see decode_utils.open_image)
+        """
+        self.urls = urls
+        self.draft_size = draft_size
+        self.batch_size = batch_size
+        # the fetcher's client is built lazily, so each worker ends up with its own
+        self.fetcher = S3Fetcher() if fetcher is None else fetcher
+
+    def __len__(self):
+        return len(self.urls)
+
+    def __getitem__(self, idx):
+        start = time.time()
+        upcoming = worker_lookahead(idx, self.fetcher.prefetch, self.batch_size, len(self.urls))
+        try:
+            data = self.fetcher.get(self.urls, upcoming)
+            return image_item(self.urls[idx], data, self.draft_size, start, time.time(), self.fetcher)
+        except Exception as e:
+            return failed_item(self.urls[idx], e, start)
+
+class AWSStreamDataset(IterableDataset):
+    def __init__(self, keys, fetcher: S3Fetcher = None, draft_size: int = None):
+        """
+        Streaming counterpart of AWSListDataset, for when the keys aren't all
+        known up front: each DataLoader worker takes s3://bucket/key URLs from
+        the shared keys queue as they're listed (see KeyStream) until it gets a
+        None, keeping up to fetcher.prefetch downloads in flight.
+
+        keys: a multiprocessing queue of URLs, ending with one None per worker
+        fetcher: the S3Fetcher used for downloads
+        draft_size: if set, JPEGs are decoded at a reduced scale that keeps both
+            sides at least this big (see decode_utils.open_image)
+        """
+        self.keys = keys
+        self.draft_size = draft_size
+        self.fetcher = S3Fetcher() if fetcher is None else fetcher
+
+    def __iter__(self):
+        # the keys taken off the queue so far, by the order they were taken in,
+        # so the fetcher can look ahead along them as it does for a list
+        urls = {}
+        taken = 0
+        i = 0
+        done = False
+        while True:
+            # only wait on the listing when there's nothing left to download
+            while not done and taken - i <= self.fetcher.prefetch:
+                try:
+                    url = self.keys.get(block=taken == i)
+                except queue.Empty:
+                    break
+                if url is None:
+                    done = True
+                else:
+                    urls[taken] = url
+                    taken += 1
+            if taken == i:
+                return
+            start = time.time()
+            try:
+                data = self.fetcher.get(urls, list(range(i, taken)))
+                item = image_item(urls[i], data, self.draft_size, start, time.time(), self.fetcher)
+            except Exception as e:
+                item = failed_item(urls[i], e, start)
+            del urls[i]
+            i += 1
+            yield item
+
+def read_list_file(path):
+    '''
+    reads a text file with one entry per line, skipping blank lines
+    '''
+    with open(path, 'r') as f:
+        return [x.strip() for x in f.readlines() if x.strip()]
+
+class Source:
+    '''
+    An input source for infer_engine. A source turns the positional inputs given
+    on the command line into a list of keys (paths or URLs), and builds the
+    Dataset that loads them. To add a new kind of input, subclass this and add
+    it to SOURCES.
+
+    inputs: the positional inputs from the command line
+    args: the rest of the parsed command line, for source-specific options
+    '''
+    # whether list_pages and stream_dataset are implemented, for --stream-listing
+    STREAM_LISTING = False
+    # the --dedup modes duplicates supports
+    DEDUP_MODES = ()
+
+    def __init__(self, inputs: List[str], args):
+        self.inputs = inputs
+        self.args = args
+
+    def list(self) -> List[str]:
+        raise NotImplementedError
+
+    def fingerprints(self, keys: List[str]) -> Dict[str, str]:
+        '''
+        a fingerprint for each key that changes whenever its contents do, used
+        by the result cache. None means the key can't be cached.
+        '''
+        return {key: None for key in keys}
+
+    def dataset(self, keys: List[str], batch_size: int, draft_size: int = None) -> Dataset:
+        raise NotImplementedError
+
+    def list_pages(self) -> Iterable[List[Tuple[str, str]]]:
+        '''
+        for sources that support --stream-listing: yields the (key, fingerprint)
+        pairs a page at a time, as they're listed
+        '''
+        raise NotImplementedError(f'{type(self).__name__} can\'t stream its listing')
+
+    def stream_dataset(self, keys, draft_size: int = None) -> IterableDataset:
+        '''
+        for sources that support --stream-listing: an IterableDataset that loads
+        keys as they come off the keys queue (see KeyStream)
+        '''
+        raise NotImplementedError(f'{type(self).__name__} can\'t stream its listing')
+
+    def duplicates(self, keys: List[str], perceptual: bool = False, max_distance: int = 0) -> Dict[str, str]:
+        '''
+        for --dedup: {duplicate key: canonical key} for keys whose contents
+        are the same as (or with perceptual, look like) an earlier key's
+        '''
+        raise NotImplementedError(f'{type(self).__name__} can\'t find duplicates')
+
+    def metadata(self, keys: List[str]) -> Dict[str, dict]:
+        '''
+        for --dedup: the EXIF position and time of each of keys, read from its
+        own header, for duplicates whose scores are copied from another key
+        '''
+        raise NotImplementedError(f'{type(self).__name__} can\'t read metadata on its own')
+
+    def wanted(self, name: str, size: int = None) -> bool:
+        '''
+        whether a listed object passes the --extensions, --min-size and --max-size filters
+        '''
+        if os.path.splitext(name)[1].lower() not in self.args.extensions:
+            return False
+        if size is not None:
+            if size < self.args.min_size or (self.args.max_size is not None and size > self.args.max_size):
+                return False
+        return True
+
+    def display_path(self, key: str) -> str:
+        '''
+        what to write in the file_path column for key
+        '''
+        return key
+
+class FileListSource(Source):
+    '''
+    local images, listed one per line in each of the input text files
+    '''
+    DEDUP_MODES = ('content', 'perceptual')
+
+    def list(self):
+        return [path for list_file in self.inputs for path in read_list_file(list_file)]
+
+    def fingerprints(self, keys):
+        return {key: file_fingerprint(key) for key in keys}
+
+    def dataset(self, keys, batch_size, draft_size=None):
+        return FileListDataset(keys, draft_size=draft_size, min_size=self.args.min_size, max_size=self.args.max_size,
+                               threads=self.args.scan_threads)
+
+    def duplicates(self, keys, perceptual=False, max_distance=0):
+        duplicates = file_duplicates(keys)
+        if perceptual:
+            unique = [key for key in keys if key not in duplicates]
+            near = perceptual_duplicates(unique, max_distance)
+            # anything that duplicated a near-duplicate goes to its canonical too
+            duplicates = {key: near.get(canonical, canonical) for key, canonical in duplicates.items()}
+            duplicates.update(near)
+        return duplicates
+
+    def metadata(self, keys):
+        with ThreadPool(self.args.scan_threads) as pool:
+            entries = pool.map(get_metadata_fast, keys, chunksize=64)
+        # unreadable files get the same empty metadata as files without EXIF
+        missing = {'lat': None, 'lon': None, 'timestamp': None}
+        return {key: missing if entry is None else {k: v for k, v in entry.items() if k != 'file_path'}
+                for key, entry in zip(keys, entries)}
+
+class DirectorySource(FileListSource):
+    '''
+    every image under each of the input directories
+    '''
+    def list(self):
+        return scan_tree(self.inputs, self.args.extensions, self.args.min_size, self.args.max_size, self.args.scan_threads)
+
+    def dataset(self, keys, batch_size, draft_size=None):
+        # scan_tree has already checked them
+        return FileListDataset(keys, draft_size=draft_size, checked=True)
+
+class URLListSource(Source):
+    '''
+    HTTP(S) image URLs - each input is either a URL or a text file with one URL per line
+    '''
+    def list(self):
+        urls = []
+        for x in self.inputs:
+            if x.startswith('http://') or x.startswith('https://'):
+                urls.append(x)
+            else:
+                urls += read_list_file(x)
+        return urls
+
+    def dataset(self, keys, batch_size, draft_size=None):
+        fetcher = HTTPFetcher(max_workers=self.args.fetch_concurrency, prefetch=self.args.prefetch)
+        return URLListDataset(keys, batch_size=batch_size, fetcher=fetcher, draft_size=draft_size)
+
+class S3PrefixSource(Source):
+    '''
+    every object under each of the input s3://bucket/prefix URLs
+    '''
+    STREAM_LISTING = True
+    # perceptual hashes would need every object downloaded first
+    DEDUP_MODES = ('content',)
+
+    def __init__(self, inputs, args):
+        super().__init__(inputs, args)
+        self.etags = {}
+        self.sizes = {}
+
+    def fetcher(self):
+        return S3Fetcher(max_workers=self.args.fetch_concurrency,
+                         prefetch=self.args.prefetch,
+                         endpoint_url=self.args.s3_endpoint,
+                         unsigned=not self.args.s3_signed)
+
+    def list_pages(self):
+        s3_client = self.fetcher().client
+        for prefix_url in self.inputs:
+            bucket_name, prefix = split_s3_url(prefix_url)
+            paginator = s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+                objects = [obj for obj in page.get('Contents', []) if self.wanted(obj['Key'], obj['Size'])]
+                for obj in objects:
+                    self.sizes[f"s3://{bucket_name}/{obj['Key']}"] = obj['Size']
+                yield [(f"s3://{bucket_name}/{obj['Key']}", obj['ETag']) for obj in objects]
+
+    def list(self):
+        urls = []
+        for page in self.list_pages():
+            for url, etag in page:
+                urls.append(url)
+                self.etags[url] = etag
+        return urls
+
+    def fingerprints(self, keys):
+        return {key: self.etags.get(key) for key in keys}
+
+    def dataset(self, keys, batch_size, draft_size=None):
+        return AWSListDataset(keys, batch_size=batch_size, fetcher=self.fetcher(), draft_size=draft_size)
+
+    def stream_dataset(self, keys, draft_size=None):
+        return AWSStreamDataset(keys, fetcher=self.fetcher(), draft_size=draft_size)
+
+    def duplicates(self, keys, perceptual=False, max_distance=0):
+        if perceptual:
+            raise NotImplementedError("perceptual dedup needs every object downloaded first, it's only supported for local files")
+        return etag_duplicates(keys, self.etags, self.sizes)
+
+    def metadata(self, keys):
+        client = self.fetcher().client
+
+        def read_metadata(url):
+            bucket_name, key = split_s3_url(url)
+            body = client.get_object(Bucket=bucket_name, Key=key)['Body']
+            try:
+                return get_metadata_stream(body.read)
+            finally:
+                # the rest of the object isn't needed
+                body.close()
+
+        with ThreadPool(self.args.fetch_concurrency) as pool:
+            return dict(zip(keys, pool.map(read_metadata, keys)))
+
+    def display_path(self, key):
+        if self.args.s3_https_paths:
+            bucket_name, object_key = split_s3_url(key)
+            return f'https://{bucket_name}.s3.amazonaws.com/{object_key}'
+        return key
+
+class KeyStream:
+    '''
+    Runs a source's listing on a background thread and feeds the keys to the
+    DataLoader workers through a multiprocessing queue as each page arrives, so
+    scoring starts after the first page rather than after the whole listing.
+
+    Call start once the DataLoader's workers are running (see the on_start of
+    iter_score_batches): a worker forked while the listing thread is inside
+    boto3 or ssl inherits the locks it holds, and hangs on them the first time
+    it builds its own client.
+
+    With a result cache, keys whose fingerprint is unchanged are looked up as
+    they're listed and (key, row) put on `cached` for the main thread to
+    write out, instead of being sent to the workers.
+
+    pages: (key, fingerprint) pairs a page at a time, from Source.list_pages
+    consumers: the number of DataLoader workers (at least 1), each of which gets
+        a None once the listing is done
+    cache_path, cache_model_name: the result cache to check, if any
+    '''
+    def __init__(self, pages: Iterable[List[Tuple[str, str]]], consumers: int,
+                 cache_path: str = None, cache_model_name: str = None):
+        self.pages = pages
+        self.consumers = max(1, consumers)
+        self.cache_path = cache_path
+        self.cache_model_name = cache_model_name
+        self.keys = multiprocessing.Queue()
+        self.cached = queue.Queue()
+        self.fingerprints = {}
+        self.listed = 0
+        self.cached_count = 0
+        self.error = None
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        # sqlite connections belong to the thread that opened them
+        cache = None if self.cache_path is None else ResultCache(self.cache_path, self.cache_model_name)
+        try:
+            for page in self.pages:
+                hits = {} if cache is None else cache.lookup(page)
+                for key, fingerprint in page:
+                    self.fingerprints[key] = fingerprint
+                    if key in hits:
+                        self.cached.put((key, hits[key]))
+                        self.cached_count += 1
+                    else:
+                        self.keys.put(key)
+                self.listed += len(page)
+        except Exception as e:
+            # the workers still get their Nones, and the engine re-raises this
+            self.error = e
+        finally:
+            if cache is not None:
+                cache.close()
+            for _ in range(self.consumers):
+                self.keys.put(None)
+
+SOURCES = {
+    'files': FileListSource,
+    'dir': DirectorySource,
+    'urls': URLListSource,
+    's3': S3PrefixSource,
+}
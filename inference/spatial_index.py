@@ -0,0 +1,335 @@
+import argparse
+import json
+import math
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+EARTH_RADIUS_KM = 6371.0088
+
+def read_results(path, chunk_size: int = 100000):
+    '''
+    yields an inference results file (a CSV, or a directory of Parquet parts
+    written by ResultWriter) as DataFrames of at most about chunk_size rows
+    '''
+    path = Path(path)
+    if path.is_dir():
+        for part in sorted(path.glob('part-*.parquet')):
+            yield pd.read_parquet(part)
+    elif path.suffix == '.parquet':
+        yield pd.read_parquet(path)
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_size, dtype={'file_path': str, 'timestamp': str},
+                               keep_default_na=False, na_values=[''])
+
+def pack_strings(strings: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    packs strings into one uint8 array of their UTF-8 bytes and an array of
+    where each one starts (plus the end), which save as .npy files without
+    pickling and can be memory-mapped
+    '''
+    encoded = [x.encode() for x in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+def unpack_strings(data: np.ndarray, offsets: np.ndarray, rows: np.ndarray) -> List[str]:
+    return [data[offsets[i]:offsets[i+1]].tobytes().decode() for i in rows]
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2
+    return 2*EARTH_RADIUS_KM*np.arcsin(np.sqrt(a))
+
+def polygon_rings(geojson: dict) -> List[List[np.ndarray]]:
+    '''
+    the rings of each polygon in a GeoJSON Polygon or MultiPolygon, or a
+    Feature or FeatureCollection of them, as (n, 2) arrays of lon, lat
+    '''
+    if geojson['type'] == 'FeatureCollection':
+        return [rings for feature in geojson['features'] for rings in polygon_rings(feature)]
+    if geojson['type'] == 'Feature':
+        return polygon_rings(geojson['geometry'])
+    if geojson['type'] == 'Polygon':
+        return [[np.asarray(ring, dtype=np.float64)[:, :2] for ring in geojson['coordinates']]]
+    if geojson['type'] == 'MultiPolygon':
+        return [[np.asarray(ring, dtype=np.float64)[:, :2] for ring in polygon] for polygon in geojson['coordinates']]
+    raise ValueError(f'expected a GeoJSON Polygon or MultiPolygon, got a {geojson["type"]}')
+
+def points_in_rings(lon: np.ndarray, lat: np.ndarray, rings: List[np.ndarray]) -> np.ndarray:
+    '''
+    even-odd ray casting against every ring of one polygon, so holes work out
+    '''
+    inside = np.zeros(len(lon), dtype=bool)
+    for ring in rings:
+        x1, y1 = ring[:, 0], ring[:, 1]
+        x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+        for ax, ay, bx, by in zip(x1, y1, x2, y2):
+            if ay == by:
+                continue
+            crosses = (ay > lat) != (by > lat)
+            inside ^= crosses & (lon < ax + (lat - ay)*(bx - ax)/(by - ay))
+    return inside
+
+class SpatialIndex:
+    '''
+    A grid index over the rows of an inference results file, for finding the
+    images in an area without reading the whole file.
+
+    The rows with a position are sorted by which cell_size x cell_size degree
+    grid cell they fall in, and each occupied cell keeps the range of sorted
+    rows in it (a CSR layout). A query only looks at the cells overlapping its
+    bounding box - each row of the grid is one contiguous range of sorted rows,
+    found with a binary search - then checks those rows exactly and applies
+    any score thresholds. So a query costs about the same however many rows
+    fall outside the area.
+
+    Positions, scores, file paths and timestamps are all kept in the index, so
+    queries never go back to the results file. Build one with
+    SpatialIndex.build(results_path, labels), save it as a directory of .npy
+    files, and load memory-maps them. Rows without a position are left out.
+    '''
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.arrays = arrays
+        self.cell_size = float(arrays['cell_size'])
+        self.columns = int(math.ceil(360/self.cell_size))
+        self.labels = [str(x) for x in arrays['labels']]
+        self.cells = arrays['cells']
+        self.offsets = arrays['offsets']
+        self.lat = arrays['lat']
+        self.lon = arrays['lon']
+        self.scores = arrays['scores']
+
+    def __len__(self):
+        return len(self.lat)
+
+    @classmethod
+    def build(cls, results_path, labels: List[str], cell_size: float = 0.01):
+        '''
+        indexes a results file written by infer_engine.py. labels are its score
+        columns, eg: infer_engine.labels - any other columns (like the tile
+        position in a --tile-output file) are left out. cell_size is in
+        degrees, 0.01 (about 1 km) suits queries over a neighbourhood to a county
+        '''
+        lat, lon, scores, paths, timestamps = [], [], [], [], []
+        labels = list(labels)
+        empty = True
+        skipped = 0
+        for chunk in read_results(results_path):
+            if empty:
+                missing = [x for x in labels if x not in chunk.columns]
+                if len(missing) > 0:
+                    raise ValueError(f'{results_path} has no score columns for {missing}')
+                empty = False
+            located = chunk['lat'].notna() & chunk['lon'].notna()
+            skipped += int((~located).sum())
+            chunk = chunk[located]
+            lat.append(chunk['lat'].to_numpy(np.float64))
+            lon.append(chunk['lon'].to_numpy(np.float64))
+            scores.append(chunk[labels].to_numpy(np.float32))
+            paths += chunk['file_path'].tolist()
+            if 'timestamp' in chunk.columns:
+                timestamps += chunk['timestamp'].fillna('').astype(str).tolist()
+            else:
+                timestamps += ['']*len(chunk)
+        if empty:
+            raise ValueError(f'{results_path} has no rows')
+        lat, lon, scores = np.concatenate(lat), np.concatenate(lon), np.concatenate(scores)
+
+        row = np.clip(np.floor((lat + 90)/cell_size), 0, None).astype(np.int64)
+        col = np.clip(np.floor((lon + 180)/cell_size), 0, int(math.ceil(360/cell_size)) - 1).astype(np.int64)
+        cell = row*int(math.ceil(360/cell_size)) + col
+        order = np.argsort(cell, kind='stable')
+        cells, starts = np.unique(cell[order], return_index=True)
+        path_data, path_offsets = pack_strings([paths[i] for i in order])
+        time_data, time_offsets = pack_strings([timestamps[i] for i in order])
+        return cls({'cell_size': np.float64(cell_size),
+                    'labels': np.array(labels),
+                    'cells': cells,
+                    'offsets': np.append(starts, len(order)).astype(np.int64),
+                    'lat': lat[order],
+                    'lon': lon[order],
+                    'scores': scores[order],
+                    'path_data': path_data,
+                    'path_offsets': path_offsets,
+                    'time_data': time_data,
+                    'time_offsets': time_offsets,
+                    'skipped': np.int64(skipped)})
+
+    def save(self, path):
+        '''
+        saves the index as a directory with one uncompressed .npy file per
+        array, written to a temporary directory that's only moved to path once
+        complete
+        '''
+        path = Path(path)
+        tmp_path = path.with_name(path.name + '.tmp')
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+        for key, array in self.arrays.items():
+            np.save(tmp_path/f'{key}.npy', array, allow_pickle=False)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        memory-maps a saved index, so opening it reads nothing but the .npy
+        headers, and a query only pages in the cells and rows it touches
+        '''
+        return cls({x.stem: np.load(x, mmap_mode='r', allow_pickle=False) for x in Path(path).glob('*.npy')})
+
+    def bbox_rows(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> np.ndarray:
+        '''
+        the sorted rows inside a bounding box, in degrees
+        '''
+        first_row = max(0, int(math.floor((min_lat + 90)/self.cell_size)))
+        last_row = int(math.floor((max_lat + 90)/self.cell_size))
+        first_col = max(0, int(math.floor((min_lon + 180)/self.cell_size)))
+        last_col = min(self.columns - 1, int(math.floor((max_lon + 180)/self.cell_size)))
+        if first_row > last_row or first_col > last_col:
+            return np.zeros(0, dtype=np.int64)
+        # one contiguous range of cells, and so of rows, per row of the grid
+        grid_rows = np.arange(first_row, last_row + 1, dtype=np.int64)*self.columns
+        lo = np.searchsorted(self.cells, grid_rows + first_col, side='left')
+        hi = np.searchsorted(self.cells, grid_rows + last_col, side='right')
+        ranges = [(self.offsets[a], self.offsets[b]) for a, b in zip(lo, hi) if b > a]
+        if len(ranges) == 0:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.concatenate([np.arange(start, end) for start, end in ranges])
+        lat, lon = self.lat[rows], self.lon[rows]
+        return rows[(lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)]
+
+    def threshold(self, rows: np.ndarray, min_scores: Dict[str, float] = None) -> np.ndarray:
+        '''
+        the rows whose score for each label in min_scores is at least its value
+        '''
+        for label, min_score in (min_scores or {}).items():
+            rows = rows[self.scores[rows, self.labels.index(label)] >= min_score]
+        return rows
+
+    def frame(self, rows: np.ndarray) -> pd.DataFrame:
+        '''
+        the rows as a DataFrame with the results file's columns
+        '''
+        df = pd.DataFrame({'file_path': unpack_strings(self.arrays['path_data'], self.arrays['path_offsets'], rows)})
+        for i in np.argsort(self.labels):
+            df[self.labels[i]] = self.scores[rows, i]
+        df['lat'] = self.lat[rows]
+        df['lon'] = self.lon[rows]
+        df['timestamp'] = pd.Series(unpack_strings(self.arrays['time_data'], self.arrays['time_offsets'], rows),
+                                    dtype='string').replace('', pd.NA)
+        return df
+
+    def bbox(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+             min_scores: Dict[str, float] = None) -> pd.DataFrame:
+        '''
+        rows inside a bounding box, optionally only those with at least
+        min_scores, eg: {'flooding_any': 0.5}
+        '''
+        return self.frame(self.threshold(self.bbox_rows(min_lat, min_lon, max_lat, max_lon), min_scores))
+
+    def radius(self, lat: float, lon: float, km: float, min_scores: Dict[str, float] = None) -> pd.DataFrame:
+        '''
+        rows within km of a point (great-circle distance), with a distance_km
+        column, nearest first. Doesn't wrap around the antimeridian.
+        '''
+        dlat = math.degrees(km/EARTH_RADIUS_KM)
+        dlon = 180. if abs(lat) + dlat >= 90 else math.degrees(km/(EARTH_RADIUS_KM*math.cos(math.radians(abs(lat) + dlat))))
+        rows = self.bbox_rows(lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+        distances = haversine_km(lat, lon, self.lat[rows], self.lon[rows])
+        rows, distances = rows[distances <= km], distances[distances <= km]
+        order = np.argsort(distances, kind='stable')
+        rows, distances = rows[order], distances[order]
+        keep = np.isin(rows, self.threshold(rows, min_scores))
+        df = self.frame(rows[keep])
+        df['distance_km'] = distances[keep]
+        return df
+
+    def polygon(self, geojson: dict, min_scores: Dict[str, float] = None) -> pd.DataFrame:
+        '''
+        rows inside a GeoJSON Polygon or MultiPolygon (or a Feature or
+        FeatureCollection of them), holes included
+        '''
+        found = []
+        for rings in polygon_rings(geojson):
+            outer = rings[0]
+            rows = self.bbox_rows(outer[:, 1].min(), outer[:, 0].min(), outer[:, 1].max(), outer[:, 0].max())
+            found.append(rows[points_in_rings(self.lon[rows], self.lat[rows], rings)])
+        rows = np.unique(np.concatenate(found)) if len(found) > 0 else np.zeros(0, dtype=np.int64)
+        return self.frame(self.threshold(rows, min_scores))
+
+def index_path(results_path) -> str:
+    '''
+    where the index for a results file is kept by default: next to it
+    '''
+    return str(Path(results_path)) + '.index'
+
+def parse_min_scores(values: List[str]) -> Dict[str, float]:
+    min_scores = {}
+    for value in values or []:
+        label, _, min_score = value.partition('=')
+        min_scores[label] = float(min_score)
+    return min_scores
+
+if __name__ == "__main__":
+    # builds a spatial index next to a results file, then queries it, eg:
+    # python spatial_index.py build outputs.csv
+    # python spatial_index.py query outputs.csv --bbox 29.5 -95.8 30.1 -95.0 --min-score flooding_any=0.5
+    # python spatial_index.py query outputs.csv --radius 29.76 -95.37 5 --output near_downtown.csv
+    # python spatial_index.py query outputs.csv --polygon aoi.geojson
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='index a results file written by infer_engine.py')
+    build_parser.add_argument('results', help='results CSV or Parquet directory')
+    build_parser.add_argument('--index', default=None, help='where to save the index, defaults to <results>.index')
+    build_parser.add_argument('--cell-size', type=float, default=0.01, help='grid cell size in degrees')
+    build_parser.add_argument('--labels', nargs='+', default=None,
+                              help='the score columns to index, defaults to the LADI labels infer_engine.py writes')
+    query_parser = subparsers.add_parser('query', help='find the images in an area')
+    query_parser.add_argument('results', help='the results file the index was built from')
+    query_parser.add_argument('--index', default=None, help='the index, defaults to <results>.index')
+    area = query_parser.add_mutually_exclusive_group(required=True)
+    area.add_argument('--bbox', nargs=4, type=float, metavar=('MIN_LAT', 'MIN_LON', 'MAX_LAT', 'MAX_LON'))
+    area.add_argument('--radius', nargs=3, type=float, metavar=('LAT', 'LON', 'KM'))
+    area.add_argument('--polygon', default=None, help='GeoJSON file with a Polygon or MultiPolygon')
+    query_parser.add_argument('--min-score', nargs='+', default=None, metavar='LABEL=SCORE',
+                              help='only images scoring at least this for each label, eg: flooding_any=0.5')
+    query_parser.add_argument('--output', default=None, help='save the matching rows to this CSV instead of printing them')
+    args = parser.parse_args()
+
+    path = args.index or index_path(args.results)
+    if args.command == 'build':
+        if args.labels is None:
+            # only imported here, since it brings in torch
+            from infer_engine import labels as ladi_labels
+            args.labels = ladi_labels
+        start = time.perf_counter()
+        index = SpatialIndex.build(args.results, args.labels, args.cell_size)
+        index.save(path)
+        print(f'indexed {len(index)} images in {len(index.cells)} cells ({int(index.arrays["skipped"])} without a position) '
+              f'in {time.perf_counter() - start:.1f}s, saved to {path}')
+    else:
+        start = time.perf_counter()
+        index = SpatialIndex.load(path)
+        loaded = time.perf_counter()
+        min_scores = parse_min_scores(args.min_score)
+        if args.bbox is not None:
+            df = index.bbox(*args.bbox, min_scores=min_scores)
+        elif args.radius is not None:
+            df = index.radius(*args.radius, min_scores=min_scores)
+        else:
+            with open(args.polygon, 'r') as f:
+                df = index.polygon(json.load(f), min_scores=min_scores)
+        queried = time.perf_counter()
+        if args.output is not None:
+            df.to_csv(args.output, index=False)
+        else:
+            print(df.to_string(index=False))
+        print(f'{len(df)} of {len(index)} images matched in {(queried - start)*1000:.1f} ms '
+              f'({(loaded - start)*1000:.1f} ms opening the index, {(queried - loaded)*1000:.1f} ms querying it)')
@@ -0,0 +1,37 @@
+'''
+Checks that perceptual_duplicates finds copies of an image saved in another
+format, and doesn't match different images. Needs pytest, eg:
+cd inference && python -m pytest test_dedup.py
+'''
+import numpy as np
+
+from PIL import Image
+
+from dedup import dhash, perceptual_duplicates
+
+def photo_like(seed, width=900, height=600):
+    '''
+    smooth blobs of colour with a little noise - random noise alone would
+    hash differently after the slightest change
+    '''
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.zeros((height, width, 3))
+    for _ in range(12):
+        cy, cx, r = rng.uniform(0, height), rng.uniform(0, width), rng.uniform(30, 200)
+        pixels += np.exp(-((y - cy)**2 + (x - cx)**2)/(2*r*r))[..., None]*rng.uniform(0, 255, 3)
+    pixels = pixels/pixels.max()*230 + rng.normal(0, 6, pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+def test_png_copy_of_jpeg_is_a_duplicate(tmp_path):
+    originals, copies = [], []
+    for i in range(8):
+        original = tmp_path/f'{i}.jpg'
+        photo_like(i).save(original, quality=85)
+        # a lossless copy of exactly the pixels the JPEG decodes to
+        Image.open(original).save(tmp_path/f'{i}.png')
+        originals.append(str(original))
+        copies.append(str(tmp_path/f'{i}.png'))
+    for original, copy in zip(originals, copies):
+        assert dhash(original) == dhash(copy)
+    assert perceptual_duplicates(originals + copies, max_distance=0) == dict(zip(copies, originals))
@@ -0,0 +1,188 @@
+'''
+Checks HTTPFetcher against a local server with injected latency (see
+fetch_utils.serve_directory): downloads come back in the order they're asked
+for, the lookahead is downloaded ahead of time, and retryable statuses are
+retried. Also checks S3Fetcher against a local stand-in for S3 (moto): large
+objects come back whole from ranged GETs, and a fetcher handed to a child
+process builds its own client and threads there. Needs pytest, and moto for
+the S3 tests, eg:
+cd inference && python -m pytest test_fetch_utils.py
+'''
+import functools
+import hashlib
+import multiprocessing
+import os
+import pickle
+import time
+import pytest
+
+from http.server import ThreadingHTTPServer
+from threading import Thread
+
+from fetch_utils import HTTPFetcher, LatencyHTTPRequestHandler, S3Fetcher, serve_directory
+
+FILES = 32
+LATENCY = 0.1
+
+@pytest.fixture
+def files(tmp_path):
+    contents = {}
+    for i in range(FILES):
+        # different sizes, so a mixed up download can't pass for the right one
+        contents[f'{i:03}.bin'] = os.urandom(1000 + i*100)
+        (tmp_path/f'{i:03}.bin').write_bytes(contents[f'{i:03}.bin'])
+    return tmp_path, contents
+
+def test_get_order_and_prefetch(files):
+    root, contents = files
+    server, base_url = serve_directory(root, latency=LATENCY)
+    names = sorted(contents)
+    urls = [f'{base_url}/{name}' for name in names]
+    fetcher = HTTPFetcher(max_workers=8, prefetch=16)
+    try:
+        start = time.perf_counter()
+        for i, name in enumerate(names):
+            upcoming = list(range(i, min(i + fetcher.prefetch, len(urls))))
+            assert fetcher.get(urls, upcoming) == contents[name]
+            # everything after i in the lookahead has been submitted already
+            assert set(fetcher._pending) == set(upcoming[1:])
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+    # one at a time would take FILES*LATENCY, 8 in flight about an eighth of that
+    assert elapsed < FILES*LATENCY/2
+
+def test_get_drops_stale_lookahead(files):
+    root, contents = files
+    server, base_url = serve_directory(root, latency=LATENCY)
+    names = sorted(contents)
+    urls = [f'{base_url}/{name}' for name in names]
+    fetcher = HTTPFetcher(max_workers=4, prefetch=4)
+    try:
+        fetcher.get(urls, [0, 1, 2, 3])
+        # jumping somewhere else cancels what's no longer expected
+        assert fetcher.get(urls, [10, 11]) == contents[names[10]]
+        assert set(fetcher._pending) == {11}
+        assert fetcher.get(urls, [11]) == contents[names[11]]
+    finally:
+        server.shutdown()
+
+class FlakyHandler(LatencyHTTPRequestHandler):
+    '''
+    answers the first `failures` requests for each path with a 503
+    '''
+    failures = 1
+    requests = None
+
+    def do_GET(self):
+        count = self.requests[self.path] = self.requests.get(self.path, 0) + 1
+        if count <= self.failures:
+            self.send_error(503)
+            return
+        super().do_GET()
+
+def serve_flaky(root, failures):
+    handler = type('Handler', (FlakyHandler,), {'failures': failures, 'requests': {}})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(handler, directory=str(root)))
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}', handler.requests
+
+def test_retries_503(files):
+    root, contents = files
+    server, base_url, requests = serve_flaky(root, failures=2)
+    fetcher = HTTPFetcher(retries=3, backoff_factor=0)
+    try:
+        assert fetcher.get([f'{base_url}/000.bin'], [0]) == contents['000.bin']
+        assert requests['/000.bin'] == 3
+    finally:
+        server.shutdown()
+
+def test_gives_up_after_retries(files):
+    root, contents = files
+    server, base_url, requests = serve_flaky(root, failures=10)
+    fetcher = HTTPFetcher(retries=2, backoff_factor=0)
+    try:
+        with pytest.raises(Exception):
+            fetcher.get([f'{base_url}/000.bin'], [0])
+        # the first try and two retries
+        assert requests['/000.bin'] == 3
+    finally:
+        server.shutdown()
+
+BUCKET = 'ladi-test'
+LARGE_SIZE = 3*2**20
+
+@pytest.fixture(scope='module')
+def s3_objects():
+    moto_server = pytest.importorskip('moto.server')
+    import boto3
+    server = moto_server.ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    endpoint = f'http://{host}:{port}'
+    client = boto3.client('s3', endpoint_url=endpoint, region_name='us-east-1',
+                          aws_access_key_id='test', aws_secret_access_key='test')
+    client.create_bucket(Bucket=BUCKET)
+    contents = {'small.bin': os.urandom(1000), 'large.bin': os.urandom(LARGE_SIZE)}
+    for key, data in contents.items():
+        client.put_object(Bucket=BUCKET, Key=key, Body=data)
+    yield endpoint, contents
+    server.stop()
+
+@pytest.fixture
+def s3_env(monkeypatch):
+    for name, value in [('AWS_ACCESS_KEY_ID', 'test'), ('AWS_SECRET_ACCESS_KEY', 'test'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')]:
+        monkeypatch.setenv(name, value)
+
+def s3_fetcher(endpoint):
+    return S3Fetcher(max_workers=2, prefetch=2, max_concurrency=4, multipart_threshold=2**20,
+                     multipart_chunksize=256*2**10, endpoint_url=endpoint, unsigned=False)
+
+def test_s3_ranged_get(s3_objects, s3_env):
+    endpoint, contents = s3_objects
+    fetcher = s3_fetcher(endpoint)
+    ranges = []
+
+    def record_range(request, **kwargs):
+        value = request.headers.get('Range')
+        ranges.append(value if value is None else value.decode())
+
+    fetcher.client.meta.events.register('before-send.s3.GetObject', record_range)
+    urls = [f's3://{BUCKET}/small.bin', f's3://{BUCKET}/large.bin']
+    assert fetcher.get(urls, [0, 1]) == contents['small.bin']
+    assert fetcher.get(urls, [1]) == contents['large.bin']
+    # the small object in one GET, the large one in multipart_chunksize ranges
+    assert ranges.count(None) == 1
+    starts = sorted(int(x.removeprefix('bytes=').split('-')[0]) for x in ranges if x is not None)
+    assert starts == list(range(0, LARGE_SIZE, fetcher.multipart_chunksize))
+
+def fetch_in_child(fetcher, pickled, url, results):
+    if pickled is not None:
+        fetcher = pickle.loads(pickled)
+    data = fetcher.get([url], [0])
+    results.put((hashlib.sha256(data).hexdigest(), id(fetcher._client), id(fetcher._executor)))
+
+@pytest.mark.parametrize('pickled', [False, True], ids=['forked', 'pickled'])
+def test_s3_fetcher_in_child(s3_objects, s3_env, pickled):
+    endpoint, contents = s3_objects
+    url = f's3://{BUCKET}/large.bin'
+    fetcher = s3_fetcher(endpoint)
+    # the parent has a client and threads of its own, which the child mustn't use
+    assert fetcher.get([url], [0]) == contents['large.bin']
+    parent_ids = (id(fetcher._client), id(fetcher._executor))
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    child = context.Process(target=fetch_in_child,
+                            args=(fetcher, pickle.dumps(fetcher) if pickled else None, url, results), daemon=True)
+    child.start()
+    child.join(60)
+    if child.exitcode is None:
+        # eg: waiting on the parent's thread pool, whose threads it doesn't have
+        child.terminate()
+        pytest.fail('the child hung')
+    assert child.exitcode == 0
+    digest, *child_ids = results.get(timeout=1)
+    assert digest == hashlib.sha256(contents['large.bin']).hexdigest()
+    # a forked copy of the parent's objects would still be at the same address
+    assert child_ids[0] != parent_ids[0] and child_ids[1] != parent_ids[1]
@@ -0,0 +1,33 @@
+'''
+Checks that the datasets in sources.py hand back a stand-in item, rather than
+raising, for an image that can't be downloaded or decoded - a DataLoader
+worker that raises ends the whole run. Needs pytest, eg:
+cd inference && python -m pytest test_sources.py
+'''
+from PIL import Image
+
+from fetch_utils import HTTPFetcher, serve_directory
+from sources import FileListDataset, URLListDataset
+
+def test_url_failures_become_failed_items(tmp_path):
+    Image.new('RGB', (64, 48), 'red').save(tmp_path/'good.jpg')
+    (tmp_path/'bad.jpg').write_text('not an image')
+    server, base_url = serve_directory(tmp_path)
+    urls = [f'{base_url}/good.jpg', f'{base_url}/missing.jpg', f'{base_url}/bad.jpg', f'{base_url}/good.jpg']
+    ds = URLListDataset(urls, batch_size=2, fetcher=HTTPFetcher(retries=0))
+    try:
+        items = [ds[i] for i in range(len(ds))]
+    finally:
+        server.shutdown()
+    assert [x['metadata']['file_path'] for x in items] == urls
+    assert [x['metadata'].get('error_type') for x in items] == [None, 'Exception', 'UnidentifiedImageError', None]
+    assert 'HTTP 404' in items[1]['metadata']['error']
+    assert items[0]['image'].size == items[3]['image'].size == (64, 48)
+
+def test_file_failures_become_failed_items(tmp_path):
+    Image.new('RGB', (64, 48), 'red').save(tmp_path/'good.png')
+    (tmp_path/'bad.png').write_bytes(b'\x89PNG not really')
+    ds = FileListDataset([str(tmp_path/'good.png'), str(tmp_path/'bad.png')])
+    assert 'error' not in ds[0]['metadata']
+    assert ds[1]['metadata']['file_path'] == str(tmp_path/'bad.png')
+    assert ds[1]['metadata']['error_type'] == 'UnidentifiedImageError'
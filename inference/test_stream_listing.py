@@ -0,0 +1,76 @@
+'''
+Runs infer_engine with --stream-listing and several DataLoader workers
+against a local stand-in for S3 (moto), a few times over, since a worker
+forked while the listing thread held a boto3 or ssl lock would hang
+intermittently rather than fail. Needs pytest and moto, eg:
+cd inference && python -m pytest test_stream_listing.py
+'''
+import os
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+from io import BytesIO
+from pathlib import Path
+from PIL import Image
+
+moto_server = pytest.importorskip('moto.server')
+import boto3
+
+from infer_engine import labels
+
+HERE = Path(__file__).resolve().parent
+BUCKET = 'ladi-test'
+IMAGES = 24
+RUNS = 3
+# a run normally takes a few seconds, so this only trips on a hang
+RUN_TIMEOUT = 120
+
+@pytest.fixture(scope='module')
+def s3_endpoint():
+    server = moto_server.ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    endpoint = f'http://{host}:{port}'
+    client = boto3.client('s3', endpoint_url=endpoint, region_name='us-east-1',
+                          aws_access_key_id='test', aws_secret_access_key='test')
+    client.create_bucket(Bucket=BUCKET)
+    rng = np.random.default_rng(0)
+    for i in range(IMAGES):
+        f = BytesIO()
+        Image.fromarray(rng.integers(0, 255, (300, 400, 3), dtype=np.uint8)).save(f, format='JPEG')
+        client.put_object(Bucket=BUCKET, Key=f'images/{i:03}.jpg', Body=f.getvalue())
+    yield endpoint
+    server.stop()
+
+@pytest.fixture(scope='module')
+def tiny_model(tmp_path_factory):
+    '''
+    a randomly initialised ViT small enough to run quickly, with the LADI labels
+    '''
+    from transformers import ViTConfig, ViTForImageClassification, ViTImageProcessor
+    path = tmp_path_factory.mktemp('model')
+    config = ViTConfig(image_size=64, patch_size=16, hidden_size=32, num_hidden_layers=1,
+                       num_attention_heads=2, intermediate_size=64,
+                       id2label=dict(enumerate(labels)), label2id={x: i for i, x in enumerate(labels)})
+    ViTForImageClassification(config).save_pretrained(path)
+    ViTImageProcessor(size={'height': 64, 'width': 64}).save_pretrained(path)
+    return str(path)
+
+@pytest.mark.parametrize('extra_args', [[], ['--tile-size', '256']], ids=['images', 'tiles'])
+def test_stream_listing_with_workers(s3_endpoint, tiny_model, tmp_path, extra_args):
+    env = {**os.environ, 'AWS_ACCESS_KEY_ID': 'test', 'AWS_SECRET_ACCESS_KEY': 'test', 'AWS_DEFAULT_REGION': 'us-east-1'}
+    output = tmp_path/'results.csv'
+    for run in range(RUNS):
+        command = [sys.executable, 'infer_engine.py', '--model', tiny_model, '--output', str(output),
+                   '--num-workers', '2', '--batch-size', '4', '--device', 'cpu',
+                   '--s3-signed', '--s3-endpoint', s3_endpoint, '--stream-listing', *extra_args,
+                   's3', f's3://{BUCKET}/images/']
+        try:
+            subprocess.run(command, cwd=HERE, env=env, check=True, timeout=RUN_TIMEOUT, capture_output=True)
+        except subprocess.TimeoutExpired:
+            pytest.fail(f'run {run} hung with {" ".join(extra_args) or "no extra args"}')
+        results = pd.read_csv(output)
+        assert sorted(results['file_path']) == [f's3://{BUCKET}/images/{i:03}.jpg' for i in range(IMAGES)]
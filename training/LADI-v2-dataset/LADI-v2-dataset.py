@@ -1,8 +1,16 @@
-import cv2
 import datasets
+import hashlib
+import json
+import os
+import tarfile
+import threading
+import time
 import pandas as pd
+import requests
+from concurrent.futures import ThreadPoolExecutor
 from datasets.data_files import DataFilesDict, sanitize_patterns
-from pathlib import Path
+from pathlib import Path, PurePosixPath
+from tqdm.auto import tqdm
 from PIL import Image, ImageFile
 
 from typing import List, Optional
@@ -51,6 +59,248 @@ SPLIT_REL_PATHS = {
                              'all':'v2/ladi_v2a_labels_train_full_resized.csv'}
 }
 
+# the archives are fetched in this many byte ranges at once, DOWNLOAD_CHUNK_SIZE
+# bytes at a time, with each range's progress saved at most every
+# STATE_INTERVAL seconds, and extracted CHUNK_SIZE bytes at a time
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_CHUNK_SIZE = 2**20
+STATE_INTERVAL = 1.
+CHUNK_SIZE = 8*2**20
+DOWNLOAD_RETRIES = 5
+
+def write_json(path, obj):
+    '''
+    writes obj to path through a temporary file, so path always holds either
+    the old or the new contents, never half of one
+    '''
+    tmp_path = Path(str(path) + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def read_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def probe_url(url, session):
+    '''
+    returns the size of the file at url, whether the server takes byte ranges
+    for it, and its ETag (so a resumed download can tell if it's changed)
+    '''
+    r = session.head(url, allow_redirects=True, timeout=60)
+    r.raise_for_status()
+    size = int(r.headers.get('Content-Length', 0)) or None
+    accepts_ranges = r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    return size, accepts_ranges, r.headers.get('ETag')
+
+def download_file(url, dest, workers: int = DOWNLOAD_WORKERS, chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+    '''
+    Downloads url to dest in `workers` byte ranges at once, resuming an
+    interrupted download where it left off.
+
+    The data goes to dest.part, and how far each range has got to
+    dest.part.json, which is only updated once those bytes have been fsynced,
+    at most every STATE_INTERVAL seconds per range and whenever a request
+    fails, so a crash loses at most a few seconds of downloading. A
+    download is resumed when both are there and the file on the server still
+    has the same size and ETag. Servers that don't take ranges get a single
+    stream, started over each time. dest only appears once it's complete.
+    '''
+    dest = Path(dest)
+    session = requests.Session()
+    size, accepts_ranges, etag = probe_url(url, session)
+    if dest.exists() and size is not None and dest.stat().st_size == size:
+        return dest
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    part_path = dest.with_name(dest.name + '.part')
+    state_path = dest.with_name(dest.name + '.part.json')
+
+    if size is None or not accepts_ranges:
+        with session.get(url, stream=True, timeout=60) as r, open(part_path, 'wb') as f:
+            r.raise_for_status()
+            for chunk in tqdm(r.iter_content(chunk_size), desc=dest.name, unit='chunk'):
+                f.write(chunk)
+        os.replace(part_path, dest)
+        return dest
+
+    state = read_json(state_path)
+    if (state is None or not part_path.exists() or part_path.stat().st_size != size
+            or [state['url'], state['size'], state['etag']] != [url, size, etag]):
+        n_parts = max(1, min(workers, size//chunk_size))
+        bounds = [size*i//n_parts for i in range(n_parts + 1)]
+        state = {'url': url, 'size': size, 'etag': etag,
+                 'parts': [[start, end - 1] for start, end in zip(bounds[:-1], bounds[1:])],
+                 'done': [0]*n_parts}
+        with open(part_path, 'wb') as f:
+            f.truncate(size)
+        write_json(state_path, state)
+
+    lock = threading.Lock()
+    progress = tqdm(total=size, initial=sum(state['done']), desc=dest.name, unit='B', unit_scale=True)
+
+    def fetch_part(i):
+        start, end = state['parts'][i]
+        for attempt in range(DOWNLOAD_RETRIES):
+            offset = start + state['done'][i]
+            if offset > end:
+                return
+            with open(part_path, 'r+b') as f:
+                written = 0
+                last_saved = time.monotonic()
+
+                def save_progress():
+                    # the bytes have to be on disk before the state says they are
+                    nonlocal written, last_saved
+                    f.flush()
+                    os.fsync(f.fileno())
+                    with lock:
+                        state['done'][i] += written
+                        write_json(state_path, state)
+                    written = 0
+                    last_saved = time.monotonic()
+
+                try:
+                    with session.get(url, headers={'Range': f'bytes={offset}-{end}'}, stream=True, timeout=60) as r:
+                        r.raise_for_status()
+                        if r.status_code != 206:
+                            raise IOError(f'{url} ignored the byte range {offset}-{end}')
+                        f.seek(offset)
+                        for chunk in r.iter_content(chunk_size):
+                            f.write(chunk)
+                            written += len(chunk)
+                            progress.update(len(chunk))
+                            if time.monotonic() - last_saved >= STATE_INTERVAL:
+                                save_progress()
+                except (requests.RequestException, IOError):
+                    if attempt == DOWNLOAD_RETRIES - 1:
+                        raise
+                    time.sleep(2**attempt)
+                finally:
+                    # whatever did arrive is kept for the next attempt (or run)
+                    save_progress()
+        if start + state['done'][i] <= end:
+            raise IOError(f'could not download bytes {start}-{end} of {url}')
+
+    with ThreadPoolExecutor(len(state['parts'])) as executor:
+        list(executor.map(fetch_part, range(len(state['parts']))))
+    progress.close()
+    os.replace(part_path, dest)
+    os.remove(state_path)
+    return dest
+
+def manifest_path_for(base_dir, url):
+    return Path(base_dir)/(PurePosixPath(url).name.split('.')[0] + '.manifest.json')
+
+def member_path(base_dir, name):
+    '''
+    where a tar member is extracted to, refusing names that would land outside base_dir
+    '''
+    rel = PurePosixPath(name)
+    if rel.is_absolute() or '..' in rel.parts:
+        raise ValueError(f'refusing to extract {name} outside of {base_dir}')
+    return Path(base_dir)/rel
+
+def extract_archive(archive, base_dir, manifest_path, url, chunk_size: int = CHUNK_SIZE):
+    '''
+    Streams the files out of a tar(.gz) archive into base_dir, CHUNK_SIZE
+    bytes at a time, recording the size and sha256 of each in a manifest
+    ({'url': ..., 'complete': bool, 'files': {name: {'size': ..., 'sha256': ...}}}).
+    Each file is written next to its destination and renamed into place once
+    its hash is known, so files in the manifest are always whole. Files
+    already in the manifest and on disk at the right size are skipped, which
+    is how an interrupted extraction picks up again.
+    '''
+    manifest = read_json(manifest_path)
+    if manifest is None or manifest.get('url') != url:
+        manifest = {'url': url, 'complete': False, 'files': {}}
+    files = manifest['files']
+    last_saved = time.monotonic()
+    with tarfile.open(archive, 'r|*') as tar:
+        for member in tqdm(tar, desc=f'extracting {Path(archive).name}', unit='file'):
+            target = member_path(base_dir, member.name)
+            if member.isdir():
+                target.mkdir(parents=True, exist_ok=True)
+                continue
+            if not member.isfile():
+                continue
+            known = files.get(member.name)
+            if (known is not None and known['size'] == member.size
+                    and target.exists() and target.stat().st_size == member.size):
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            tmp_target = target.with_name(target.name + '.tmp')
+            digest = hashlib.sha256()
+            source = tar.extractfile(member)
+            with open(tmp_target, 'wb') as f:
+                while chunk := source.read(chunk_size):
+                    digest.update(chunk)
+                    f.write(chunk)
+            os.replace(tmp_target, target)
+            files[member.name] = {'size': member.size, 'sha256': digest.hexdigest()}
+            if time.monotonic() - last_saved > 10:
+                write_json(manifest_path, manifest)
+                last_saved = time.monotonic()
+    manifest['complete'] = True
+    write_json(manifest_path, manifest)
+    return manifest
+
+def file_sha256(path, chunk_size: int = CHUNK_SIZE):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def missing_files(base_dir, manifest, verify: bool = False, workers: int = DOWNLOAD_WORKERS):
+    '''
+    the names in a manifest whose files aren't in base_dir at the recorded
+    size, or, with verify, whose sha256 doesn't match either
+    '''
+    def is_missing(item):
+        name, entry = item
+        path = member_path(base_dir, name)
+        try:
+            if path.stat().st_size != entry['size']:
+                return True
+        except OSError:
+            return True
+        return verify and file_sha256(path) != entry['sha256']
+
+    items = list(manifest['files'].items())
+    with ThreadPoolExecutor(workers) as executor:
+        flags = executor.map(is_missing, items, chunksize=256)
+        return [name for (name, _), missing in zip(items, flags) if missing]
+
+def fetch_ladi(url, base_dir, workers: int = DOWNLOAD_WORKERS, verify: bool = False):
+    '''
+    Makes sure the contents of the archive at url are in base_dir. Nothing is
+    downloaded if a complete manifest from an earlier run says they're already
+    there (and, with verify, every file's sha256 still matches). Otherwise the
+    archive is downloaded to base_dir/downloads, resuming if it was
+    interrupted, and extracted, skipping files that already were. The archive
+    can be deleted once its manifest is complete.
+    '''
+    base_dir = Path(base_dir)
+    base_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = manifest_path_for(base_dir, url)
+    manifest = read_json(manifest_path)
+    if manifest is not None and manifest.get('url') == url and manifest.get('complete'):
+        missing = missing_files(base_dir, manifest, verify, workers)
+        if len(missing) == 0:
+            return manifest
+        print(f'{len(missing)} files from {url} are missing or changed, extracting them again')
+        for name in missing:
+            del manifest['files'][name]
+        manifest['complete'] = False
+        write_json(manifest_path, manifest)
+    archive = download_file(url, base_dir/'downloads'/PurePosixPath(url).name, workers)
+    return extract_archive(archive, base_dir, manifest_path, url)
+
 class LadiClassifyDatasetConfig(datasets.BuilderConfig):
     def __init__(self, 
                  name: str = 'v2a_resized',
@@ -59,6 +309,9 @@ class LadiClassifyDatasetConfig(datasets.BuilderConfig):
                  download_ladi = False,
                  data_name: Optional[str] = None,
                  label_name: Optional[str] = None,
+                 decode_images: bool = True,
+                 download_workers: int = DOWNLOAD_WORKERS,
+                 verify_download: bool = False,
                  **kwargs):
         """
         split_csvs: a dictionary mapping split names to existing csv files containing annotations
@@ -66,6 +319,11 @@ class LadiClassifyDatasetConfig(datasets.BuilderConfig):
         base_dir: the base directory of the label CSVs and data files.
         data_name: the version of the data you're using. Used to determine what files to download if
             you don't specify split_csvs or url_list. Must be in DATA_URLS.keys().
+        decode_images: if False, the image column holds {'path': ..., 'bytes': None} instead of a
+            PIL image, and it's up to you to decode it (eg: with training/decode_utils.py)
+        download_workers: how many byte ranges of the archive are downloaded at once
+        verify_download: if True, the sha256 of every extracted file is checked against
+            the manifest written when it was extracted, rather than just its size
             
         If split_csvs is None, the requested data will be downloaded from the hub. Please do NOT 
             use this feature with streaming=True, you will perform a large download every time.
@@ -75,6 +333,9 @@ class LadiClassifyDatasetConfig(datasets.BuilderConfig):
         self.label_name = name if label_name is None else label_name
         self.base_dir = None if base_dir is None else Path(base_dir)
         self.split_csvs = split_csvs
+        self.decode_images = decode_images
+        self.download_workers = download_workers
+        self.verify_download = verify_download
 
         if self.data_name not in DATA_URLS.keys():
             raise ValueError(f"Expected data_name to be one of {DATA_URLS.keys()}, got {self.data_name}")
@@ -131,7 +392,7 @@ class LADIClassifyDataset(datasets.GeneratorBasedBuilder):
         if self.config.label_name == "v1_damage":
             features = datasets.Features(
                 {
-                    "image":datasets.Image(),
+                    "image":datasets.Image(decode=self.config.decode_images),
                     "flood":datasets.Value("bool"),
                     "rubble":datasets.Value("bool"),
                     "misc_damage":datasets.Value("bool")
@@ -140,7 +401,7 @@ class LADIClassifyDataset(datasets.GeneratorBasedBuilder):
         elif self.config.label_name == "v1_infrastructure":
             features = datasets.Features(
                  {
-                    "image":datasets.Image(),
+                    "image":datasets.Image(decode=self.config.decode_images),
                     "building":datasets.Value("bool"),
                     "road":datasets.Value("bool")
                 }
@@ -148,7 +409,7 @@ class LADIClassifyDataset(datasets.GeneratorBasedBuilder):
         elif self.config.label_name in ["v2", "v2_resized"]:
             features = datasets.Features(
                 {
-                    "image":datasets.Image(),
+                    "image":datasets.Image(decode=self.config.decode_images),
                     "bridges_any": datasets.Value("bool"),
                     "bridges_damage": datasets.Value("bool"),
                     "buildings_affected": datasets.Value("bool"),
@@ -169,7 +430,7 @@ class LADIClassifyDataset(datasets.GeneratorBasedBuilder):
         elif self.config.label_name in ["v2a", "v2a_resized"]:
             features = datasets.Features(
                 {
-                    "image":datasets.Image(),
+                    "image":datasets.Image(decode=self.config.decode_images),
                     "bridges_any": datasets.Value("bool"),
                     "buildings_any": datasets.Value("bool"),
                     "buildings_affected_or_greater": datasets.Value("bool"),
@@ -196,83 +457,74 @@ class LADIClassifyDataset(datasets.GeneratorBasedBuilder):
             # supervised_keys=("image", "label"),
         )
     
-    def read_ann_csv(self, fpath):
+    def read_ann_csv(self, fpath, **kwargs):
         if self.config.data_name == 'v1':
-            return pd.read_csv(fpath, sep='\t', index_col=False)
-        return pd.read_csv(fpath, sep=',', index_col=False)
+            return pd.read_csv(fpath, sep='\t', index_col=False, **kwargs)
+        return pd.read_csv(fpath, sep=',', index_col=False, **kwargs)
+
+    def read_label_cols(self, fpath):
+        '''
+        the label columns of an annotation file, from its header alone
+        '''
+        return tuple(label for label in self.read_ann_csv(fpath, nrows=0).columns if label not in ['url','local_path'])
 
     def _split_generators(self, dl_manager):
         generators = []
         data_files = self.config.split_csvs
 
         if self.config.download_ladi:
-            # download data files to config.base_dir
-            dl_url = dl_manager.download(DATA_URLS[self.config.data_name])
-            base_dir = Path(self.config.base_dir)
-            tar_iterator = dl_manager.iter_archive(dl_url)
-            base_dir.mkdir(exist_ok=True)
-            for filename, file in tar_iterator:
-                file_path: Path = base_dir/filename
-                file_path.parent.mkdir(parents=True, exist_ok=True)
-                with open(base_dir/filename, 'wb') as f:
-                    f.write(file.read())
+            # download data files to config.base_dir, skipping whatever an
+            # earlier run already downloaded and extracted
+            fetch_ladi(DATA_URLS[self.config.data_name], self.config.base_dir,
+                       workers=self.config.download_workers, verify=self.config.verify_download)
+            if data_files is None:
+                data_files = SPLIT_REL_PATHS[self.config.label_name]
 
         data_files = DataFilesDict.from_local_or_remote(
             sanitize_patterns(data_files), 
             base_path=self.config.base_dir
         )
 
-        if 'train' in data_files.keys():
-            train_df = self.read_ann_csv(data_files['train'][0])
-            label_cols = tuple(label for label in train_df.columns if label not in ['url','local_path'])
-            train_examples = [x._asdict() for x in train_df.itertuples()]
-            generators.append(datasets.SplitGenerator(
-                name=datasets.Split.TRAIN,
-                gen_kwargs={"examples":train_examples,
-                            "label_cols":label_cols}
-            ))
-        if 'val' in data_files.keys():
-            val_df = self.read_ann_csv(data_files['val'][0])
-            label_cols = tuple(label for label in val_df.columns if label not in ['url','local_path'])
-            val_examples = [x._asdict() for x in val_df.itertuples()]
-            generators.append(datasets.SplitGenerator(
-                name=datasets.Split.VALIDATION,
-                gen_kwargs={"examples":val_examples,
-                            "label_cols":label_cols}
-            ))
-        if 'test' in data_files.keys():
-            test_df = self.read_ann_csv(data_files['test'][0])
-            label_cols = tuple(label for label in test_df.columns if label not in ['url','local_path'])
-            test_examples = [x._asdict() for x in test_df.itertuples()]
-            generators.append(datasets.SplitGenerator(
-                name=datasets.Split.TEST,
-                gen_kwargs={"examples":test_examples,
-                            "label_cols":label_cols}
-            ))
-        if 'all' in data_files.keys():
-            all_df = self.read_ann_csv(data_files['all'][0])
-            label_cols = tuple(label for label in all_df.columns if label not in ['url','local_path'])
-            all_examples = [x._asdict() for x in all_df.itertuples()]
-            generators.append(datasets.SplitGenerator(
-                name=datasets.Split.ALL,
-                gen_kwargs={"examples":all_examples,
-                            "label_cols":label_cols}
-            ))
+        # only the header is read here - the rows are streamed from the CSV by
+        # _generate_examples, so nothing is held in memory per example
+        split_names = {'train': datasets.Split.TRAIN,
+                       'val': datasets.Split.VALIDATION,
+                       'test': datasets.Split.TEST,
+                       'all': datasets.Split.ALL}
+        for key, split_name in split_names.items():
+            if key in data_files.keys():
+                generators.append(datasets.SplitGenerator(
+                    name=split_name,
+                    gen_kwargs={"csv_path":data_files[key][0],
+                                "label_cols":self.read_label_cols(data_files[key][0])}
+                ))
 
         return generators
 
-    def _generate_examples(self, examples, label_cols, from_url_list=False):
-        for ex in examples:
+    def _generate_examples(self, csv_path, label_cols, from_url_list=False, chunk_size=10000):
+        label_cols = list(label_cols)
+        chunks = self.read_ann_csv(csv_path,
+                                   usecols=['local_path', *label_cols],
+                                   dtype={'local_path': str, **{k: bool for k in label_cols}},
+                                   chunksize=chunk_size)
+        for chunk in chunks:
+            yield from self._generate_chunk_examples(chunk, label_cols)
+
+    def _generate_chunk_examples(self, chunk, label_cols):
+        columns = [chunk[k].tolist() for k in label_cols]
+        for local_path, *values in zip(chunk['local_path'].tolist(), *columns):
+            ex = {'local_path': local_path, **dict(zip(label_cols, values))}
             try:
                 image_path = Path(ex['local_path'])
                 if not image_path.is_absolute():
-                    image_path = str(self.config.base_dir/image_path)
+                    image_path = self.config.base_dir/image_path
+                image_path = str(image_path)
             except:
                 print(ex)
                 raise
             
-            image = cv2.imread(image_path)
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            # the path is stored as is and the image only decoded when it's read,
+            # rather than decoded here and re-encoded by the Image feature
             labels = {k:ex[k] for k in label_cols}
-            labels |= {"image":image}
+            labels |= {"image":image_path}
             yield image_path, labels
\ No newline at end of file
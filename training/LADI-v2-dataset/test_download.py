@@ -0,0 +1,132 @@
+'''
+Checks fetch_ladi against a local HTTP server that takes byte ranges and can
+be told to drop the connection part way through: an interrupted download
+resumes where it stopped, the extracted files match the archive, and later
+runs only check the manifest. Needs pytest and datasets, eg:
+cd training/LADI-v2-dataset && python -m pytest test_download.py
+'''
+import hashlib
+import importlib.util
+import os
+import re
+import tarfile
+import threading
+import pytest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+pytest.importorskip('datasets')
+spec = importlib.util.spec_from_file_location('ladi_v2_dataset', Path(__file__).with_name('LADI-v2-dataset.py'))
+ladi = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(ladi)
+
+ARCHIVE = 'ladi_test.tar.gz'
+FILES = 6
+FILE_SIZE = 2**20
+
+class RangeHandler(BaseHTTPRequestHandler):
+    '''
+    serves the files in server.root with byte range support, closing the
+    connection once server.fail_after bytes (if set) have been sent in total
+    '''
+    def send_file(self, body: bool):
+        path = self.server.root/self.path.lstrip('/')
+        if not path.is_file():
+            self.send_error(404)
+            return
+        size = path.stat().st_size
+        start, end = 0, size - 1
+        match = re.fullmatch(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        if match is not None:
+            start, end = int(match[1]), min(int(match[2]), size - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"test"')
+        self.end_headers()
+        if not body:
+            return
+        with open(path, 'rb') as f:
+            f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                data = f.read(min(65536, left))
+                with self.server.lock:
+                    if self.server.fail_after is not None and self.server.sent + len(data) > self.server.fail_after:
+                        self.close_connection = True
+                        return
+                    self.server.sent += len(data)
+                self.wfile.write(data)
+                left -= len(data)
+
+    def do_HEAD(self):
+        self.send_file(False)
+
+    def do_GET(self):
+        self.send_file(True)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path/'server'
+    (root/'src'/'images').mkdir(parents=True)
+    for i in range(FILES):
+        (root/'src'/'images'/f'{i}.bin').write_bytes(os.urandom(FILE_SIZE))
+    with tarfile.open(root/ARCHIVE, 'w:gz') as tar:
+        tar.add(root/'src'/'images', arcname='images')
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    httpd.root = root
+    httpd.lock = threading.Lock()
+    httpd.sent = 0
+    httpd.fail_after = None
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+
+def sha256(path):
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+def test_resume_and_verify(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(ladi, 'DOWNLOAD_RETRIES', 1)
+    url = f'http://127.0.0.1:{server.server_address[1]}/{ARCHIVE}'
+    base_dir = tmp_path/'ladi'
+    archive_size = (server.root/ARCHIVE).stat().st_size
+    downloaded = base_dir/'downloads'/ARCHIVE
+
+    # the connection drops half way through, leaving a partial download behind
+    server.fail_after = archive_size//2
+    with pytest.raises(Exception):
+        ladi.fetch_ladi(url, base_dir, workers=4)
+    state = ladi.read_json(str(downloaded) + '.part.json')
+    assert 0 < sum(state['done']) <= archive_size//2
+
+    # the next run only downloads what's missing
+    server.fail_after = None
+    server.sent = 0
+    manifest = ladi.fetch_ladi(url, base_dir, workers=4)
+    assert server.sent == archive_size - sum(state['done'])
+    assert sha256(downloaded) == sha256(server.root/ARCHIVE)
+    assert manifest['complete'] and len(manifest['files']) == FILES
+    for name, entry in manifest['files'].items():
+        assert sha256(base_dir/name) == sha256(server.root/'src'/name) == entry['sha256']
+
+    # once the manifest is complete nothing is downloaded, even without the archive
+    os.remove(downloaded)
+    server.sent = 0
+    ladi.fetch_ladi(url, base_dir)
+    assert server.sent == 0
+
+    # a file changed in place is only caught by verify, and extracted again
+    corrupted = base_dir/'images'/'0.bin'
+    with open(corrupted, 'r+b') as f:
+        f.write(b'corrupt')
+    ladi.fetch_ladi(url, base_dir)
+    assert sha256(corrupted) != manifest['files']['images/0.bin']['sha256']
+    ladi.fetch_ladi(url, base_dir, verify=True)
+    assert sha256(corrupted) == manifest['files']['images/0.bin']['sha256']
@@ -0,0 +1,82 @@
+import argparse
+import time
+import cv2
+import numpy as np
+
+from io import BytesIO
+from pathlib import Path
+from PIL import Image
+
+from decode_utils import load_image_array
+
+def eager_decode(path):
+    '''
+    what the dataset used to do for each sample: cv2.imread at full size and a
+    cvtColor copy, re-encoding to PNG in the datasets.Image feature, decoding
+    that back to PIL, then np.array in config_dataloader.preprocess. Returns the
+    array and the bytes of every buffer made along the way.
+    '''
+    bgr = cv2.imread(str(path))
+    rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+    f = BytesIO()
+    # datasets.Image stores uint8 arrays as PNG
+    Image.fromarray(rgb).save(f, format='PNG')
+    encoded = f.getvalue()
+    img = Image.open(BytesIO(encoded))
+    img.load()
+    array = np.array(img)
+    return array, bgr.nbytes + rgb.nbytes + len(encoded) + len(img.tobytes()) + array.nbytes
+
+def lazy_decode(path, min_size=None):
+    array = load_image_array(str(path), min_size)
+    return array, array.nbytes
+
+def time_method(paths, method, repeats=3):
+    '''
+    returns the CPU seconds and MB of buffers per sample for method, taking the
+    best of `repeats` passes over paths
+    '''
+    times = []
+    copied = 0
+    for _ in range(repeats):
+        elapsed = 0.
+        copied = 0
+        for path in paths:
+            start = time.process_time()
+            _, nbytes = method(path)
+            elapsed += time.process_time() - start
+            copied += nbytes
+        times.append(elapsed/len(paths))
+    return min(times), copied/len(paths)/2**20
+
+if __name__ == "__main__":
+    # compares the old decode path of LADI-v2-dataset.py against decoding once
+    # with decode_utils.load_image_array, at full and reduced resolution, eg:
+    # python benchmark_decode.py ladi_dataset/v2_resized --size 258
+    parser = argparse.ArgumentParser()
+    parser.add_argument('images', help='text file with one image path per line, or a directory of JPEGs')
+    parser.add_argument('--size', type=int, default=258,
+                        help='smallest side needed after decoding, eg: the model input size times the cache scale')
+    parser.add_argument('--limit', type=int, default=20, help='number of images to time')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    source = Path(args.images)
+    if source.is_dir():
+        paths = sorted(p for p in source.rglob('*') if p.suffix.lower() in ['.jpg', '.jpeg'])
+    else:
+        paths = [Path(x.strip()) for x in source.read_text().splitlines() if x.strip()]
+    paths = paths[:args.limit]
+    if len(paths) == 0:
+        raise SystemExit(f'no images found in {args.images}')
+    with Image.open(paths[0]) as img:
+        print(f'{len(paths)} images, eg: {img.size[0]}x{img.size[1]}, reduced decoding to at least {args.size}px')
+
+    methods = {'eager (old)': eager_decode,
+               'lazy': lazy_decode,
+               'lazy, reduced': lambda path: lazy_decode(path, args.size)}
+    results = {name: time_method(paths, method, args.repeats) for name, method in methods.items()}
+    baseline_time = results['eager (old)'][0]
+    print(f'{"":>16}{"CPU ms/sample":>15}{"MB copied/sample":>18}{"speedup":>9}')
+    for name, (cpu, mb) in results.items():
+        print(f'{name:>16}{cpu*1000:>15.1f}{mb:>18.1f}{baseline_time/cpu:>8.1f}x')
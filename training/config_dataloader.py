@@ -4,18 +4,27 @@ import numpy as np
 
 from torch.utils.data import DataLoader
 from albumentations.pytorch import ToTensorV2
+from accelerate import PartialState
 from hydra_zen import builds, store, MISSING
 from functools import partial
+from typing import Optional
 
 from datasets import Dataset
 from transformers import AutoImageProcessor
 
+from decode_utils import load_image_array
+from memmap_cache import MemmapDataset, cache_size_for, ensure_split_cache, split_cache_dir
+
 def get_dataloaders(dataset: Dataset,
                     image_processor: AutoImageProcessor,
                     labels,
                     splits:list[str],
                     per_device_batch_size:int,
-                    num_workers_per_process:int):
+                    num_workers_per_process:int,
+                    cache_dir:Optional[str]=None,
+                    cache_scale:float=1.15,
+                    reduced_decode:bool=False,
+                    split_fingerprints:Optional[dict]=None):
     """
     This function is internal to this file - it is exposed via global state by
     means of the Hydra store below.
@@ -24,6 +33,16 @@ def get_dataloaders(dataset: Dataset,
     DataLoaders will properly convert the formatting of labels and apply any
     training augmentations as part of the preprocessing. Parameters from image_processor 
     will be used to properly resize and normalize the images.
+
+    If cache_dir is set, each split is decoded once into memory-mapped uint8
+    shards under it (see memmap_cache.py), at cache_scale times the model's
+    input size, and the DataLoaders read from those instead of decoding every
+    JPEG every epoch. The cache is built by the main process the first time,
+    and rebuilt when a split's entry in split_fingerprints (from
+    config_dataset.get_datasets) changes.
+
+    If reduced_decode is set, images are decoded at 1/2, 1/4 or 1/8 scale
+    whenever that still leaves them cache_scale times the model's input size.
     """
     dataloaders = {}
         
@@ -32,12 +51,14 @@ def get_dataloaders(dataset: Dataset,
     else:
         size = (image_processor.size["height"], image_processor.size["width"])
     normalize = A.Normalize(mean=image_processor.image_mean, std=image_processor.image_std)
+    min_decode_size = cache_size_for(size, cache_scale) if reduced_decode else None
     
     def preprocess(example_batch, transforms):
         """Apply transforms across a batch, also converts labels from key:bool to a vector of floats"""
         images = example_batch["image"]
-        # albumentations expects image as np.array, so we cast it to array first
-        example_batch["pixel_values"] = [transforms(image=np.array(image))['image']
+        # albumentations expects image as np.array, which images are decoded
+        # straight into (see decode_utils.py)
+        example_batch["pixel_values"] = [transforms(image=load_image_array(image, min_decode_size))['image']
                                          for image in example_batch["image"]]
         labels_batch = {k: example_batch[k] for k in example_batch.keys() if k in labels}
         labels_matrix = np.zeros((len(images), len(labels)))
@@ -46,6 +67,22 @@ def get_dataloaders(dataset: Dataset,
         example_batch["labels"] = labels_matrix.tolist()    
         return example_batch
     
+    def split_dataset(split, transforms):
+        """
+        the split with transforms applied, from the memmap cache if there is one
+        """
+        if cache_dir is not None:
+            cache_size = cache_size_for(size, cache_scale)
+            path = split_cache_dir(cache_dir, dataset[split], split, cache_size)
+            with PartialState().main_process_first():
+                ensure_split_cache(dataset[split], labels, path, cache_size,
+                                   fingerprint=(split_fingerprints or {}).get(split))
+            return MemmapDataset(path, transforms)
+        return dataset[split].map(partial(preprocess, transforms=transforms),
+                                  batch_size=1,
+                                  batched=True,
+                                  remove_columns=dataset[split].column_names)
+
     def collate_fn(examples):
         """
         converts a batch into single set of tensors
@@ -71,11 +108,7 @@ def get_dataloaders(dataset: Dataset,
     
     # add augmentations
     if 'train' in splits:
-        preprocess_train = partial(preprocess, transforms=train_transforms)
-        train_dataset = dataset['train'].map(preprocess_train,
-                                             batch_size=1,
-                                             batched=True,
-                                             remove_columns=dataset['train'].column_names)
+        train_dataset = split_dataset('train', train_transforms)
         dataloaders['train'] = DataLoader(train_dataset,
                                           collate_fn=collate_fn,
                                           batch_size=per_device_batch_size,
@@ -83,22 +116,14 @@ def get_dataloaders(dataset: Dataset,
                                          )
     if 'all' in splits:
         all_transforms = train_transforms
-        preprocess_all = partial(preprocess, transforms=all_transforms)
-        all_dataset = dataset['all'].map(preprocess_all,
-                                         batch_size=1,
-                                         batched=True,
-                                         remove_columns=dataset['all'].column_names)
+        all_dataset = split_dataset('all', all_transforms)
         dataloaders['all'] = DataLoader(all_dataset,
                                           collate_fn=collate_fn,
                                           batch_size=per_device_batch_size,
                                           num_workers=num_workers_per_process
                                          )
     if 'validation' in splits:
-        preprocess_val = partial(preprocess, transforms=val_transforms)
-        val_dataset = dataset['validation'].map(preprocess_val,
-                                                batch_size=1,
-                                                batched=True,
-                                                remove_columns=dataset['validation'].column_names)
+        val_dataset = split_dataset('validation', val_transforms)
         dataloaders['validation'] = DataLoader(val_dataset,
                                           collate_fn=collate_fn,
                                           batch_size=per_device_batch_size,
@@ -106,11 +131,7 @@ def get_dataloaders(dataset: Dataset,
                                          )
     if 'test' in splits:
         test_transforms = val_transforms
-        preprocess_test = partial(preprocess, transforms=test_transforms)
-        test_dataset = dataset['test'].map(preprocess_test,
-                                           batch_size=1,
-                                           batched=True,
-                                           remove_columns=dataset['test'].column_names)
+        test_dataset = split_dataset('test', test_transforms)
         dataloaders['test'] = DataLoader(test_dataset,
                                           collate_fn=collate_fn,
                                           batch_size=per_device_batch_size,
@@ -130,6 +151,8 @@ def register_configs():
                 zen_partial=True)
     default_dataloader_config = dataloader_builder(splits=['train','validation','test', 'all'])
     full_training_dataloader_config = dataloader_builder(splits=['all'])
+    cached_dataloader_config = dataloader_builder(splits=['train','validation','test', 'all'],
+                                                  cache_dir='./ladi_cache')
 
     store_dl = store(group="dataloader_builder")
             
@@ -139,4 +162,7 @@ def register_configs():
     store_dl(full_training_dataloader_config,
         name='full')
 
+    store_dl(cached_dataloader_config,
+        name='cached')
+
     store_dl.add_to_hydra_store()
\ No newline at end of file
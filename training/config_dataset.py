@@ -1,11 +1,89 @@
+import json
+import os
 import pandas as pd
 
+from accelerate import PartialState
 from hydra_zen import builds, store, MISSING, make_config
 from datasets import load_dataset, load_dataset_builder
 from datasets.data_files import DataFilesDict, sanitize_patterns
 from typing import Optional, Literal
 from pathlib import Path
 
+# bump when the manifest layout changes, so old ones get rebuilt
+MANIFEST_VERSION = 1
+
+def manifest_path_for(dataset_base_dir: str, dataset_config_name: str) -> Path:
+    return Path(dataset_base_dir)/'.manifests'/f'{dataset_config_name}.json'
+
+def file_fingerprint(path) -> dict:
+    stat = os.stat(path)
+    return {'path': str(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def read_manifest(path, labels):
+    '''
+    the manifest at path, or None if there isn't one, it's for other labels,
+    or any of the split CSVs it was computed from have changed since
+    '''
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != MANIFEST_VERSION or manifest['labels'] != list(labels):
+            return None
+        for fingerprint in manifest['files'].values():
+            if file_fingerprint(fingerprint['path']) != fingerprint:
+                return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return manifest
+
+def build_manifest(dataset_base_dir: str, dataset_config_name: str, labels, chunk_size: int = 100000) -> dict:
+    '''
+    Reads every split CSV of a dataset config once, counting its rows and the
+    positive examples of each label, and fingerprints the CSVs (size and
+    modification time) so the counts can be reused until they change:
+    {'version': ..., 'labels': [...], 'files': {split: fingerprint},
+     'rows': {split: n}, 'positives': {split: {label: n}}}
+    '''
+    ds_builder_cls = load_dataset_builder('MITLL/LADI-v2-dataset', dataset_config_name,
+                           trust_remote_code=True, base_dir=dataset_base_dir)
+    data_files = DataFilesDict.from_local_or_remote(
+            sanitize_patterns(ds_builder_cls.config.split_csvs),
+            base_path=ds_builder_cls.config.base_dir
+        )
+    sep = '\t' if ds_builder_cls.config.data_name == 'v1' else ','
+
+    manifest = {'version': MANIFEST_VERSION, 'labels': list(labels), 'files': {}, 'rows': {}, 'positives': {}}
+    for split, files in data_files.items():
+        csv_path = files[0]
+        rows = 0
+        positives = pd.Series(0, index=list(labels), dtype='int64')
+        for chunk in pd.read_csv(csv_path, sep=sep, usecols=list(labels), chunksize=chunk_size):
+            rows += len(chunk)
+            positives += chunk.sum().astype('int64')
+        manifest['files'][split] = file_fingerprint(csv_path)
+        manifest['rows'][split] = rows
+        manifest['positives'][split] = {label: int(n) for label, n in positives.items()}
+    return manifest
+
+def load_manifest(dataset_base_dir: str, dataset_config_name: str, labels) -> dict:
+    '''
+    the manifest for a dataset config, built and saved under
+    dataset_base_dir/.manifests only if there isn't an up to date one. The
+    main process goes first, so with several processes the CSVs are read
+    once and the rest find the saved manifest
+    '''
+    path = manifest_path_for(dataset_base_dir, dataset_config_name)
+    with PartialState().main_process_first():
+        manifest = read_manifest(path, labels)
+        if manifest is None:
+            manifest = build_manifest(dataset_base_dir, dataset_config_name, labels)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(path.name + f'.{os.getpid()}.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(tmp_path, path)
+    return manifest
+
 def get_datasets(dataset_base_dir: str,
                  dataset_config_name: str,
                  train_split: Literal['train', 'all']):
@@ -19,33 +97,27 @@ def get_datasets(dataset_base_dir: str,
     train_split: which train split to use - 'train' trains on the training set,
         'all' trains on all data
     
-    returns HF dataset, list of labels, and class weights
+    returns HF dataset, list of labels, class weights, and split fingerprints
     class weights are the ratio of negative to positive examples
+    split fingerprints map each split to the size and modification time of its
+    CSV, for telling when a cache of the split is out of date (see memmap_cache.py)
     '''
-    # when dataset is on Hub we can use a non-local version
+    # when dataset is on Hub we can use a non-local version. Images are left
+    # as paths and decoded once, by the dataloaders (see decode_utils.py)
     dataset = load_dataset('MITLL/LADI-v2-dataset', dataset_config_name, 
                            streaming=True, trust_remote_code=True, 
-                           base_dir=dataset_base_dir)
+                           base_dir=dataset_base_dir, decode_images=False)
     labels = [x for x in dataset["train"].column_names if x != "image"]
 
     if train_split not in ['train', 'all']:
         raise ValueError('only train_split=train or train_split=all is supported')
     
-    ds_builder_cls = load_dataset_builder('MITLL/LADI-v2-dataset', dataset_config_name, 
-                           trust_remote_code=True, base_dir=dataset_base_dir)
-    data_files = DataFilesDict.from_local_or_remote(
-            sanitize_patterns(ds_builder_cls.config.split_csvs), 
-            base_path=ds_builder_cls.config.base_dir
-        )
-    
-    if ds_builder_cls.config.data_name == 'v1':
-        train_df = pd.read_csv(data_files[train_split][0], sep='\t')
-    else:
-        train_df = pd.read_csv(data_files[train_split][0])
-    
-    pos_examples = train_df[labels].sum()
-    class_weights = (len(train_df) - pos_examples)/pos_examples
-    return dataset, labels, class_weights
+    # the label counts come from a manifest, so the split CSVs are only read
+    # again when they change (see load_manifest)
+    manifest = load_manifest(dataset_base_dir, dataset_config_name, labels)
+    pos_examples = pd.Series(manifest['positives'][train_split])[labels]
+    class_weights = (manifest['rows'][train_split] - pos_examples)/pos_examples
+    return dataset, labels, class_weights, manifest['files']
 
 ## Dataset configs
 def register_configs(data_base_dir: Optional[str]):
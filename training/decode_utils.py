@@ -0,0 +1,58 @@
+import os
+import cv2
+import numpy as np
+
+from io import BytesIO
+from PIL import Image
+
+# cv2's reduced decoding flags, largest reduction first. For JPEGs libjpeg
+# decodes straight to the smaller size, skipping most of the work
+REDUCED_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8),
+                 (4, cv2.IMREAD_REDUCED_COLOR_4),
+                 (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+def decode_flag(width: int, height: int, min_size: int = None) -> int:
+    '''
+    the cv2.imread flag for the largest reduction that keeps both sides of a
+    width x height image at least min_size pixels, or a full decode
+    '''
+    if min_size is not None:
+        for factor, flag in REDUCED_FLAGS:
+            if min(width, height)//factor >= min_size:
+                return flag
+    return cv2.IMREAD_COLOR
+
+def load_image_array(image, min_size: int = None) -> np.ndarray:
+    '''
+    Decodes an image from the dataset into an RGB uint8 (height, width, 3)
+    array, the form albumentations works on, with a single decode and no
+    further copies.
+
+    image: what the dataset's image column holds - a {'path': ..., 'bytes': ...}
+        dict (with decode_images=False), a path, or a PIL image or array that's
+        already been decoded
+    min_size: if set, the image is decoded at 1/2, 1/4 or 1/8 scale when that
+        still leaves both sides at least min_size pixels (only the header is
+        read to find out)
+    '''
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, Image.Image):
+        return np.array(image.convert('RGB'))
+    if isinstance(image, dict):
+        path, data = image.get('path'), image.get('bytes')
+    else:
+        path, data = os.fspath(image), None
+
+    flag = cv2.IMREAD_COLOR
+    if min_size is not None:
+        with Image.open(BytesIO(data) if data is not None else path) as img:
+            flag = decode_flag(*img.size, min_size)
+    if data is not None:
+        array = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    else:
+        array = cv2.imread(path, flag)
+    if array is None:
+        raise OSError(f'could not decode {path or "image bytes"}')
+    # cv2 decodes to BGR, swapped in place rather than into a new array
+    return cv2.cvtColor(array, cv2.COLOR_BGR2RGB, dst=array)
@@ -0,0 +1,194 @@
+import json
+import math
+import os
+import shutil
+import cv2
+import numpy as np
+
+from pathlib import Path
+from torch.utils.data import Dataset
+from tqdm.auto import tqdm
+
+from decode_utils import load_image_array
+
+INDEX_FILE = 'index.json'
+# bump when the way images are cached changes, so old caches get rebuilt
+CACHE_VERSION = 2
+
+def cache_size_for(image_size, scale: float = 1.15) -> int:
+    '''
+    the side length images are cached at: a little bigger than the model input
+    (image_size is (height, width)), so RandomResizedCrop still has some
+    pixels to throw away
+    '''
+    return int(math.ceil(max(image_size)*scale))
+
+def split_cache_dir(cache_dir, split_dataset, split: str, size: int) -> Path:
+    '''
+    where a split is cached: under the dataset config's name, so v2 and
+    v2_resized (which have the same labels) don't share a cache
+    '''
+    config_name = getattr(getattr(split_dataset, 'info', None), 'config_name', None) or 'default'
+    return Path(cache_dir)/config_name/f'{split}-{size}px'
+
+def resize_center_crop(image: np.ndarray, size: int) -> np.ndarray:
+    '''
+    scales an image so its shorter side is size, keeping its aspect ratio, and
+    cuts the size x size square out of the middle
+    '''
+    height, width = image.shape[:2]
+    scale = size/min(height, width)
+    new_width, new_height = max(size, round(width*scale)), max(size, round(height*scale))
+    # INTER_AREA averages over the source pixels, which is what you want when shrinking
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    image = cv2.resize(image, (new_width, new_height), interpolation=interpolation)
+    top, left = (new_height - size)//2, (new_width - size)//2
+    return image[top:top+size, left:left+size]
+
+def read_index(path):
+    try:
+        with open(Path(path)/INDEX_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def build_split_cache(split_dataset, labels, path, size: int, fingerprint=None, shard_size: int = 1024):
+    """
+    Decodes every image of a split once, scales it to size on its shorter side
+    and center-crops it to size x size (see resize_center_crop), and writes it
+    to uint8 .npy shards of shard_size images each, along with a float32 label
+    matrix (columns in the order of labels) and an index.json that also
+    records the row count and fingerprint. The shards are written to a
+    temporary directory that's only moved to path once complete, so a crashed
+    build is never mistaken for a cache.
+
+    split_dataset: one split of the dataset from config_dataset.get_datasets,
+        yielding {'image': ..., <label>: bool, ...}
+    fingerprint: something JSON-serializable that changes whenever the split's
+        rows do, eg: the size and modification time of its CSV from the
+        dataset manifest (see config_dataset.get_datasets). It should be taken
+        before the build reads any rows, so an edit made during the build means
+        a rebuild next time
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+
+    shards = []
+    label_rows = []
+    shard = None
+    filled = 0
+
+    def close_shard():
+        nonlocal shard
+        name = f'images-{len(shards):05}.npy'
+        if filled < shard_size:
+            # the last shard is cut down to the images it actually holds
+            np.save(tmp_path/name, shard[:filled])
+            os.remove(tmp_path/'partial.npy')
+        else:
+            shard.flush()
+            os.replace(tmp_path/'partial.npy', tmp_path/name)
+        shard = None
+        shards.append({'file': name, 'count': filled})
+
+    for example in tqdm(split_dataset, desc=f'caching {path.name}'):
+        if shard is None:
+            shard = np.lib.format.open_memmap(tmp_path/'partial.npy', mode='w+', dtype=np.uint8,
+                                              shape=(shard_size, size, size, 3))
+            filled = 0
+        # nothing smaller than size is needed, so big JPEGs are decoded at a reduced scale
+        image = load_image_array(example['image'], min_size=size)
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        shard[filled] = resize_center_crop(image[..., :3], size)
+        label_rows.append([float(example[label]) for label in labels])
+        filled += 1
+        if filled == shard_size:
+            close_shard()
+    if shard is not None:
+        close_shard()
+
+    np.save(tmp_path/'labels.npy', np.asarray(label_rows, dtype=np.float32).reshape(-1, len(labels)))
+    with open(tmp_path/INDEX_FILE, 'w') as f:
+        json.dump({'version': CACHE_VERSION,
+                   'size': size,
+                   'count': len(label_rows),
+                   'labels': list(labels),
+                   'fingerprint': fingerprint,
+                   'shards': shards}, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+def ensure_split_cache(split_dataset, labels, path, size: int, fingerprint=None, shard_size: int = 1024):
+    '''
+    builds the cache for a split unless one for the same labels, size and
+    fingerprint (see build_split_cache) is already at path. Without a
+    fingerprint, only new labels or sizes rebuild the cache
+    '''
+    index = read_index(path)
+    if (index is None or index.get('version') != CACHE_VERSION or index['labels'] != list(labels)
+            or index['size'] != size or index.get('fingerprint') != fingerprint):
+        build_split_cache(split_dataset, labels, path, size, fingerprint, shard_size)
+
+class MemmapDataset(Dataset):
+    """
+    Reads a split cached by build_split_cache straight from its memory-mapped
+    shards, so each epoch only pays for the augmentations rather than for
+    decoding full-size JPEGs. Items are in the same form as the preprocessed
+    HF dataset's: {"pixel_values": ..., "labels": [...]}.
+
+    The shards are opened on first use in each process, so the dataset can be
+    handed to DataLoader workers without copying any pixels.
+
+    transforms: an albumentations transform taking image= (HWC uint8)
+    """
+    def __init__(self, path, transforms=None):
+        self.path = Path(path)
+        self.transforms = transforms
+        self.index = read_index(self.path)
+        if self.index is None:
+            raise FileNotFoundError(f'no cache at {self.path}, build it with build_split_cache')
+        self.labels = np.load(self.path/'labels.npy')
+        counts = [x['count'] for x in self.index['shards']]
+        self.starts = np.cumsum([0] + counts)
+        self.shards = None
+
+    def __len__(self):
+        return self.index['count']
+
+    def __getitem__(self, idx):
+        if self.shards is None:
+            self.shards = [np.load(self.path/x['file'], mmap_mode='r') for x in self.index['shards']]
+        shard = int(np.searchsorted(self.starts, idx, side='right')) - 1
+        image = np.asarray(self.shards[shard][idx - self.starts[shard]])
+        pixel_values = image if self.transforms is None else self.transforms(image=image)['image']
+        return {"pixel_values": pixel_values, "labels": self.labels[idx].tolist()}
+
+    def __getstate__(self):
+        # memmaps are reopened in each worker rather than pickled
+        return {**self.__dict__, 'shards': None}
+
+if __name__ == "__main__":
+    # builds the caches ahead of a training run, eg:
+    # python memmap_cache.py --dataset v2_resized --model google/vit-base-patch16-224-in21k --cache-dir ./ladi_cache
+    # then train with dataloader_builder=cached (or dataloader_builder.cache_dir=./ladi_cache)
+    import argparse
+    from transformers import AutoImageProcessor
+    from config_dataloader import get_dataloaders
+    from config_dataset import get_datasets
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default='v2_resized', help='config name from LadiClassifyDataset.BUILDER_CONFIGS')
+    parser.add_argument('--data-dir', default='./ladi_dataset', help='base directory of the LADI dataset')
+    parser.add_argument('--model', required=True, help='the model whose image processor sets the input size')
+    parser.add_argument('--cache-dir', default='./ladi_cache')
+    parser.add_argument('--cache-scale', type=float, default=1.15, help='cache images at this times the model input size')
+    parser.add_argument('--splits', nargs='+', default=['train', 'validation', 'test', 'all'])
+    args = parser.parse_args()
+
+    dataset, labels, _, split_fingerprints = get_datasets(args.data_dir, args.dataset, 'train')
+    image_processor = AutoImageProcessor.from_pretrained(args.model)
+    get_dataloaders(dataset, image_processor, labels, args.splits, per_device_batch_size=1, num_workers_per_process=0,
+                    cache_dir=args.cache_dir, cache_scale=args.cache_scale, split_fingerprints=split_fingerprints)
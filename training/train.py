@@ -187,11 +187,12 @@ def task(dataset,
     Main entrypoint - gets the dataset, model, optimizer, etc from their builders
     and begins the training process
     """
-    dataset, labels, class_weights = dataset
+    dataset, labels, class_weights, split_fingerprints = dataset
     image_processor, model, model_id = model_builder(labels=labels)
     dataloaders = dataloader_builder(dataset,
                           image_processor,
-                          labels)
+                          labels,
+                          split_fingerprints=split_fingerprints)
     optimizer = optimizer_builder(model)
     
     # flatten the config for logging